@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""Archive helpers for UAF-Plankline
+    Segmentation tars can be written uncompressed, gzip compressed (single
+    threaded gzip or parallel pigz) or zstd compressed (multithreaded). The
+    codec and level are set in the [general] section. Readers never rely on
+    the config: the format of each tar is detected from its first bytes, so a
+    directory can hold a mix of outputs.
+
+        codec   extension   program
+        none    .tar
+        gzip    .tar.gz     gzip (in process)
+        pigz    .tar.gz     pigz -p <threads>
+        zstd    .tar.zst    zstd -T<threads>
+
+    Next to each tar, segmentation writes a sidecar index <tar>.idx listing
+    the byte offset and size of every member. For uncompressed tars readers
+    can then seek (or pread in parallel) straight to the members they need
+    instead of walking every header. For compressed tars the offsets refer to
+    the decompressed stream.
+
+Usage:
+    import archive
+    ./archive.py <tar> [<tar> ...]     (index existing tars)
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import csv
+import shutil
+import tarfile
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+EXTENSIONS = {'none': '.tar', 'gzip': '.tar.gz', 'pigz': '.tar.gz', 'zstd': '.tar.zst'}
+READ_EXTENSIONS = ['.tar.gz', '.tar.zst', '.tar.bz2', '.tar.xz', '.tgz', '.tar']
+
+MAGIC = [(b'\x1f\x8b', 'gzip'), (b'\x28\xb5\x2f\xfd', 'zstd'), (b'BZh', 'bzip2'), (b'\xfd7zXZ\x00', 'xz')]
+
+
+def codec_settings(config):
+    """(codec, level, threads) from [general]; a blank archive_codec follows compress_output."""
+    codec = config['general'].get('archive_codec', fallback = '').strip()
+    if codec == '':
+        codec = 'gzip' if config['general']['compress_output'] == 'True' else 'none'
+    if codec not in EXTENSIONS:
+        raise ValueError(f"Unknown archive_codec {codec}, use one of {', '.join(EXTENSIONS)}")
+
+    level = config['general'].get('archive_level', fallback = '').strip()
+    level = int(level) if level != '' else (3 if codec == 'zstd' else 6)
+    threads = int(config['general'].get('archive_threads', fallback = '0'))
+    return codec, level, threads
+
+
+def extension(codec):
+    return EXTENSIONS[codec]
+
+
+def is_archive(path):
+    return any([path.endswith(ext) for ext in READ_EXTENSIONS])
+
+
+def strip_extension(path):
+    """Name of an archive without its directory and tar extension."""
+    name = os.path.basename(path)
+    for ext in READ_EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def detect(path):
+    """Compression of an archive from its magic bytes: none, gzip, zstd, bzip2 or xz."""
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, codec in MAGIC:
+        if head.startswith(magic):
+            return codec
+    return 'none'
+
+
+def compress_command(codec, level, threads):
+    """External compressor reading stdin and writing stdout, or None if done in process."""
+    if codec == 'pigz':
+        return ['pigz', f'-{level}'] + (['-p', str(threads)] if threads > 0 else [])
+    if codec == 'zstd':
+        return ['zstd', '-q', f'-{level}', f'-T{threads}']
+    return None
+
+
+def decompress_command(codec):
+    """Fastest available decompressor for codec writing to stdout, or None if not compressed."""
+    if codec == 'gzip':
+        return ['pigz', '-dc'] if shutil.which('pigz') else ['gzip', '-dc']
+    if codec == 'zstd':
+        return ['zstd', '-dc', '-T0']
+    if codec == 'bzip2':
+        return ['pbzip2', '-dc'] if shutil.which('pbzip2') else ['bzip2', '-dc']
+    if codec == 'xz':
+        return ['xz', '-dc', '-T0']
+    return None
+
+
+def tar_option(command):
+    """GNU tar option running command as the (de)compression program."""
+    if command is None:
+        return ''
+    return f'-I "{" ".join(command)}"'
+
+
+def create_option(codec, level, threads):
+    """GNU tar option for writing an archive with codec (used with tar -cf)."""
+    if codec == 'gzip':
+        return tar_option(['gzip', f'-{level}'])
+    return tar_option(compress_command(codec, level, threads))
+
+
+def extract_option(path):
+    """GNU tar option for reading path with a parallel decompressor where there is one (used with tar -xf)."""
+    return tar_option(decompress_command(detect(path)))
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+class IndexedTarFile(tarfile.TarFile):
+    """TarFile that remembers where the data of every member it writes starts."""
+
+    def addfile(self, tarinfo, fileobj = None):
+        super().addfile(tarinfo, fileobj)
+        if tarinfo.isreg():
+            padded = -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.index.append((tarinfo.name, self.offset - padded, tarinfo.size))
+
+
+def write_index(index_file, entries, codec, tar_size):
+    """Write (name, offset, size) entries; the first line records what they are valid for."""
+    with open(index_file + '.part', 'w', newline = '') as f:
+        f.write(f"# codec={codec} size={tar_size}\n")
+        writer = csv.writer(f)
+        writer.writerow(['name', 'offset', 'size'])
+        writer.writerows(entries)
+    os.replace(index_file + '.part', index_file)
+
+
+def read_index(path):
+    """{name: (offset, size)} from the index of path, or None if missing or not for this tar."""
+    index_file = index_path(path)
+    if not os.path.isfile(index_file):
+        return None
+
+    with open(index_file, newline = '') as f:
+        header = dict([field.split('=') for field in f.readline()[1:].split()])
+        if int(header.get('size', -1)) != os.path.getsize(path):
+            return None # tar was rewritten since
+        reader = csv.reader(f)
+        next(reader)
+        return {name: (int(offset), int(size)) for name, offset, size in reader}
+
+
+def build_index(path, index_file = None):
+    """Index an existing tar by walking its headers once; returns the number of members."""
+    entries = []
+    with Reader(path) as tar:
+        for member in tar:
+            if member.isreg():
+                entries.append((member.name, member.offset_data, member.size))
+    write_index(index_file or index_path(path), entries, detect(path), os.path.getsize(path))
+    return len(entries)
+
+
+def extract_members(path, names, dest, threads = 8):
+    """Extract the named members of path into dest, flattened to their basenames.
+
+    Uses the index of an uncompressed tar to pread members in parallel without
+    reading any headers. Otherwise the archive is read once, in order, keeping
+    only the wanted members. Returns the list of files written.
+    """
+    names = set(names)
+    return list(extract_matching(path, lambda name: name in names, lambda name: os.path.join(dest, os.path.basename(name)), threads).values())
+
+
+def extract_matching(path, wanted, dest, threads = 8):
+    """Write every member for which wanted(name) is true to the file dest(name).
+
+    Same strategy as extract_members; returns {member name: file written}.
+    """
+    index = read_index(path) if detect(path) == 'none' else None
+    written = {}
+
+    if index is not None:
+        fd = os.open(path, os.O_RDONLY)
+        def copy(name):
+            offset, size = index[name]
+            out = dest(name)
+            with open(out, 'wb') as f:
+                f.write(os.pread(fd, size, offset))
+            return name, out
+        try:
+            with ThreadPoolExecutor(threads) as pool:
+                written = dict(pool.map(copy, [name for name in index if wanted(name)]))
+        finally:
+            os.close(fd)
+        return written
+
+    with Reader(path) as tar:
+        for member in tar:
+            if member.isreg() and wanted(member.name):
+                out = dest(member.name)
+                with open(out, 'wb') as f:
+                    shutil.copyfileobj(tar.extractfile(member), f)
+                written[member.name] = out
+    return written
+
+
+def read_matching(path, wanted):
+    """Yield (member name, data) for every member for which wanted(name) is true, in archive order."""
+    index = read_index(path) if detect(path) == 'none' else None
+
+    if index is not None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            for name, (offset, size) in sorted(index.items(), key = lambda item: item[1][0]):
+                if wanted(name):
+                    yield name, os.pread(fd, size, offset)
+        finally:
+            os.close(fd)
+        return
+
+    with Reader(path) as tar:
+        for member in tar:
+            if member.isreg() and wanted(member.name):
+                yield member.name, tar.extractfile(member).read()
+
+
+class Writer:
+    """A tarfile for writing, compressed in process or through an external compressor.
+
+    Use as a context manager; the archive is complete once the block exits.
+    If index_file is given the member index is written there as well.
+    """
+
+    def __init__(self, path, codec = 'none', level = 6, threads = 0, index_file = None):
+        self._proc = None
+        self._out = None
+        self.path = path
+        self.codec = codec
+        self.index_file = index_file
+        command = compress_command(codec, level, threads)
+        if command is None:
+            self.tar = IndexedTarFile.open(path, 'w:gz' if codec == 'gzip' else 'w', **({'compresslevel': level} if codec == 'gzip' else {}))
+        else:
+            self._out = open(path, 'wb')
+            self._proc = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = self._out)
+            self.tar = IndexedTarFile.open(fileobj = self._proc.stdin, mode = 'w|')
+        self.tar.index = []
+
+    def __enter__(self):
+        return self.tar
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tar.close()
+        if self._proc is not None:
+            self._proc.stdin.close()
+            returncode = self._proc.wait()
+            self._out.close()
+            if returncode != 0 and exc_type is None:
+                raise subprocess.CalledProcessError(returncode, self._proc.args)
+        if self.index_file is not None and exc_type is None:
+            write_index(self.index_file, self.tar.index, self.codec, os.path.getsize(self.path))
+        return False
+
+
+class Reader:
+    """A tarfile for sequential reading of any supported archive.
+
+    zstd (and any codec with a faster external decompressor) is piped through
+    that program, so members must be read in order.
+    """
+
+    def __init__(self, path):
+        self._proc = None
+        codec = detect(path)
+        if codec == 'none':
+            self.tar = tarfile.open(path, 'r:')
+        elif codec == 'gzip' and not shutil.which('pigz'):
+            self.tar = tarfile.open(path, 'r:gz')
+        else:
+            self._proc = subprocess.Popen(decompress_command(codec) + [path], stdout = subprocess.PIPE)
+            self.tar = tarfile.open(fileobj = self._proc.stdout, mode = 'r|')
+
+    def __enter__(self):
+        return self.tar
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tar.close()
+        if self._proc is not None:
+            self._proc.stdout.close()
+            self._proc.wait()
+        return False
+
+
+if __name__ == "__main__":
+    """Build missing or stale indexes for existing tars."""
+
+    parser = argparse.ArgumentParser(description="Writes the <tar>.idx member index for tars made before indexes existed.")
+    parser.add_argument("tars", nargs = '+', help = "Tar files to index.")
+    parser.add_argument("-f", "--force", action = "store_true", help = "Rebuild indexes that are already up to date.")
+    args = parser.parse_args()
+
+    for tar in args.tars:
+        if not args.force and read_index(tar) is not None:
+            continue
+        print(f"Indexed {build_index(tar)} members of {tar}")
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Classification cache for UAF-Plankline
+    Re-segmenting a transect with slightly different settings gives mostly
+    byte-identical crops. The cache keeps the SCNN result row of every crop
+    keyed on a hash of the crop's content and the model (basename, epoch and
+    classification settings), so classify only sends crops it has not seen
+    before to the GPU and assembles its csv from cached and new rows.
+
+    Rows are stored as the text SCNN wrote (zlib compressed), so a cached
+    result is identical to a fresh one. The cache is one SQLite file shared
+    by all classification workers and runs. It is bounded by size: once the
+    stored rows exceed the limit, the least recently used ones are evicted.
+
+Usage:
+    import cache
+    crop_cache = cache.Cache(path, max_bytes)
+    hits = crop_cache.get(model, hashes)
+    crop_cache.put(model, header, {hash: row})
+    ./cache.py <cache.sqlite>    (print what is in the cache)
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import zlib
+import json
+import hashlib
+import sqlite3
+import argparse
+from time import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, header TEXT);
+CREATE TABLE IF NOT EXISTS crops (hash TEXT, model TEXT, row BLOB, size INTEGER, used REAL, PRIMARY KEY (hash, model));
+CREATE INDEX IF NOT EXISTS crops_used ON crops (used);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+INSERT OR IGNORE INTO meta VALUES ('bytes', 0);
+"""
+
+# Queries are split so the number of parameters stays below SQLite's limit.
+CHUNK = 500
+
+
+def content_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size = 16).hexdigest()
+
+
+class Cache:
+    """SCNN result rows keyed on (crop content hash, model), bounded to max_bytes of stored rows."""
+
+    def __init__(self, path, max_bytes = 0):
+        self.path = path
+        self.max_bytes = max_bytes # 0 for no limit
+        self._conn = None
+        self._pid = None
+
+    def conn(self):
+        """Connection of the current process (connections must not cross a fork)."""
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout = 300)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def header(self, model):
+        """csv header SCNN wrote for model, or None if nothing is cached for it."""
+        found = self.conn().execute('SELECT header FROM models WHERE model = ?', (model,)).fetchone()
+        return json.loads(found[0]) if found else None
+
+    def get(self, model, hashes):
+        """{hash: row values} for the hashes that are cached for model; marks them as used."""
+        hashes = list(set(hashes))
+        hits = {}
+        conn = self.conn()
+        for i in range(0, len(hashes), CHUNK):
+            chunk = hashes[i:i + CHUNK]
+            sql = f"SELECT hash, row FROM crops WHERE model = ? AND hash IN ({', '.join(['?'] * len(chunk))})"
+            for h, row in conn.execute(sql, [model] + chunk):
+                hits[h] = json.loads(zlib.decompress(row))
+        with conn:
+            now = time()
+            conn.executemany('UPDATE crops SET used = ? WHERE hash = ? AND model = ?', [(now, h, model) for h in hits])
+        return hits
+
+    def put(self, model, header, rows):
+        """Cache {hash: row values} for model, then evict the least recently used rows if over the limit."""
+        conn = self.conn()
+        now = time()
+        added = 0
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO models VALUES (?, ?)', (model, json.dumps(header)))
+            for h, row in rows.items():
+                blob = zlib.compress(json.dumps(row).encode('utf-8'))
+                if conn.execute('INSERT OR IGNORE INTO crops VALUES (?, ?, ?, ?, ?)', (h, model, blob, len(blob), now)).rowcount > 0:
+                    added += len(blob)
+            conn.execute("UPDATE meta SET value = value + ? WHERE key = 'bytes'", (added,))
+        self.evict()
+
+    def size(self):
+        return self.conn().execute("SELECT value FROM meta WHERE key = 'bytes'").fetchone()[0]
+
+    def evict(self):
+        """Delete least recently used rows until the cache is below 90% of max_bytes. Returns rows deleted."""
+        if self.max_bytes <= 0 or self.size() <= self.max_bytes:
+            return 0
+        conn = self.conn()
+        deleted = 0
+        with conn:
+            excess = self.size() - int(self.max_bytes * 0.9)
+            while excess > 0:
+                oldest = conn.execute('SELECT hash, model, size FROM crops ORDER BY used LIMIT ?', (CHUNK,)).fetchall()
+                if len(oldest) == 0:
+                    break
+                conn.executemany('DELETE FROM crops WHERE hash = ? AND model = ?', [(h, model) for h, model, size in oldest])
+                freed = sum([size for h, model, size in oldest])
+                conn.execute("UPDATE meta SET value = value - ? WHERE key = 'bytes'", (freed,))
+                excess -= freed
+                deleted += len(oldest)
+        return deleted
+
+
+if __name__ == "__main__":
+    """Summarise a cache file."""
+
+    parser = argparse.ArgumentParser(description="Prints the number of cached crops per model.")
+    parser.add_argument("cache", help = "Cache sqlite file.")
+    args = parser.parse_args()
+
+    crop_cache = Cache(args.cache)
+    print(f"{args.cache}: {crop_cache.size()/10**6:.1f} MB of results")
+    for model, n in crop_cache.conn().execute('SELECT model, COUNT(*) FROM crops GROUP BY model'):
+        print(f"{model}: {n} crops")
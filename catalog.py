@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""Crop catalog for UAF-Plankline
+    One SQLite database per transect, catalog.sqlite in the segmentation
+    directory, that records where every crop lives:
+
+        tars(tar, avi, size, mtime)          the AVI each tar was made from
+        crops(name, tar, frame)              the tar and frame of every crop
+        results(name, tar, result, row)      the result file(s) and row of every crop
+
+    Segmentation adds a tar's crops as soon as the tar is written (from its
+    member index) and classification adds the rows of every result file it
+    writes, so lookups by crop name, tar or result file need neither a glob
+    nor a scan of the csv files. Results of several models can be recorded
+    for the same transect. Existing transects are catalogued with
+    ./catalog.py, which only adds tars and results that are new or changed.
+
+Usage:
+    import catalog
+    catalog.add_tar(segment_dir, tar, avi)
+    catalog.add_result(segment_dir, tar, result, names)
+    ./catalog.py <segmentation dir> [<classification dir> ...] [-q <crop> ...]
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import re
+import sqlite3
+import argparse
+
+import archive
+import manifest
+
+CATALOG_NAME = 'catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tars (tar TEXT PRIMARY KEY, avi TEXT, size INTEGER, mtime INTEGER);
+CREATE TABLE IF NOT EXISTS crops (name TEXT, tar TEXT, frame INTEGER, PRIMARY KEY (name, tar));
+CREATE TABLE IF NOT EXISTS results (name TEXT, tar TEXT, result TEXT, row INTEGER, PRIMARY KEY (name, tar, result));
+CREATE TABLE IF NOT EXISTS result_files (result TEXT PRIMARY KEY, tar TEXT, size INTEGER, mtime INTEGER);
+CREATE INDEX IF NOT EXISTS crops_tar ON crops (tar);
+CREATE INDEX IF NOT EXISTS results_result ON results (result);
+"""
+
+
+def catalog_path(segment_dir):
+    return os.path.join(segment_dir, CATALOG_NAME)
+
+
+def connect(segment_dir):
+    conn = sqlite3.connect(catalog_path(segment_dir), timeout = 300) # workers of both stages write to it
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def frame_number(name, tar_id):
+    """Frame of a crop from its name ('<avi>_<frame>...'), or None."""
+    m = re.search(re.escape(tar_id) + r'[_-](\d+)', name)
+    return int(m.group(1)) if m else None
+
+
+def tar_members(tar):
+    """Member names of a tar, from its index when there is one."""
+    index = archive.read_index(tar)
+    if index is not None:
+        return list(index)
+    with archive.Reader(tar) as t:
+        return [member.name for member in t if member.isreg()]
+
+
+def add_tar(segment_dir, tar, avi = None):
+    """Record the crops of a (complete) tar, replacing what was recorded for it (or another tar of the same AVI) before."""
+    tar_name = os.path.basename(tar)
+    tar_id = archive.strip_extension(tar_name)
+    avi = os.path.basename(avi) if avi else tar_id + '.avi'
+    rows = []
+    for member in tar_members(tar):
+        name = os.path.basename(member)
+        rows.append((name, tar_name, frame_number(name, tar_id)))
+
+    conn = connect(segment_dir)
+    with conn:
+        conn.execute('DELETE FROM crops WHERE tar = ? OR tar IN (SELECT tar FROM tars WHERE avi = ?)', (tar_name, avi))
+        conn.execute('DELETE FROM tars WHERE avi = ? AND tar != ?', (avi, tar_name))
+        conn.executemany('INSERT OR REPLACE INTO crops VALUES (?, ?, ?)', rows)
+        conn.execute('INSERT OR REPLACE INTO tars VALUES (?, ?, ?, ?)', (tar_name, avi, os.path.getsize(tar), int(os.path.getmtime(tar))))
+    conn.close()
+    return len(rows)
+
+
+def add_result(segment_dir, tar, result, names):
+    """Record that row i of result (csv or npy) holds the crop names[i] of tar."""
+    tar_name = os.path.basename(tar)
+    result = os.path.abspath(result)
+    conn = connect(segment_dir)
+    gone = [(r,) for r, in conn.execute('SELECT result FROM result_files WHERE tar = ?', (tar_name,)) if not os.path.isfile(r)]
+    with conn:
+        conn.executemany('DELETE FROM results WHERE result = ?', gone + [(result,)]) # also results since replaced, e.g. csv by npy
+        conn.executemany('DELETE FROM result_files WHERE result = ?', gone)
+        conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', [(os.path.basename(name), tar_name, result, i) for i, name in enumerate(names)])
+        conn.execute('INSERT OR REPLACE INTO result_files VALUES (?, ?, ?, ?)', (result, tar_name, os.path.getsize(result), int(os.path.getmtime(result))))
+    conn.close()
+    return len(names)
+
+
+def locate(segment_dir, name):
+    """[{avi, tar, frame, result, row}] for a crop name; result/row are None if not classified."""
+    conn = connect(segment_dir)
+    found = conn.execute('''SELECT t.avi, c.tar, c.frame, r.result, r.row FROM crops c
+        JOIN tars t ON t.tar = c.tar LEFT JOIN results r ON r.name = c.name AND r.tar = c.tar
+        WHERE c.name = ?''', (name,)).fetchall()
+    conn.close()
+    return [dict(zip(['avi', 'tar', 'frame', 'result', 'row'], f)) for f in found]
+
+
+def result_tars(segment_dir):
+    """{result file: tar} of every recorded result."""
+    conn = connect(segment_dir)
+    found = dict(conn.execute('SELECT result, tar FROM result_files'))
+    conn.close()
+    return found
+
+
+def update(segment_dir, classification_dirs = ()):
+    """Catalog the tars and result files that are new or changed since they were recorded. Returns (tars, results) added."""
+    import results # numpy is only needed to read results
+
+    conn = connect(segment_dir)
+    known_tars = {tar: (size, mtime) for tar, size, mtime in conn.execute('SELECT tar, size, mtime FROM tars')}
+    known_results = {result: (size, mtime) for result, size, mtime in conn.execute('SELECT result, size, mtime FROM result_files')}
+    conn.close()
+
+    n_tars = 0
+    seg_entries = manifest.load(segment_dir)
+    avis = {os.path.basename(e['output']): avi for avi, e in seg_entries.items()}
+    for tar in sorted(os.listdir(segment_dir)):
+        path = os.path.join(segment_dir, tar)
+        if not archive.is_archive(tar) or known_tars.get(tar) == (os.path.getsize(path), int(os.path.getmtime(path))):
+            continue
+        add_tar(segment_dir, path, avis.get(tar))
+        n_tars += 1
+
+    n_results = 0
+    for classification_dir in classification_dirs:
+        for tar, entry in manifest.load(classification_dir).items():
+            result = os.path.abspath(entry['output'])
+            if not os.path.isfile(result) or known_results.get(result) == (os.path.getsize(result), int(os.path.getmtime(result))):
+                continue
+            add_result(segment_dir, tar, result, results.load(result)[0])
+            n_results += 1
+    return n_tars, n_results
+
+
+if __name__ == "__main__":
+    """Catalog an existing transect and optionally look up crops."""
+
+    parser = argparse.ArgumentParser(description="Builds or updates catalog.sqlite, which maps every crop to its AVI, frame, tar and result rows.")
+    parser.add_argument("segmentation", help = "Segmentation directory of the transect.")
+    parser.add_argument("classification", nargs = '*', help = "Classification directories (one per model) whose results to add.")
+    parser.add_argument("-q", "--query", nargs = '+', help = "Crop names to look up.")
+    args = parser.parse_args()
+
+    n_tars, n_results = update(args.segmentation, args.classification)
+    print(f"Added {n_tars} tars and {n_results} result files to {catalog_path(args.segmentation)}")
+    for name in args.query or []:
+        for found in locate(args.segmentation, name) or [{}]:
+            print(name, found)
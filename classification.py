@@ -31,62 +31,138 @@ License:
 import os
 import sys
 import shutil
+import tarfile
 import argparse
 import glob
+import csv
+import fnmatch
 import logging
 import configparser
 import logging.config
 import tqdm
-import subprocess
 import datetime
 from time import time
-from multiprocessing import Pool, Queue
+from multiprocessing import Pool
 import psutil
 
+import archive
+import cache
+import catalog
+import dedupe
+import devices
+import results
+import store
+import manifest
+import monitor
+import scheduler
+import scratch
 
-def classify(tar_file):
-    """Classify images contained within a TAR file."""
-    
-    timer_classify = time()
-    logger.info("Starting classify")
-    logger.debug(f"Basename for model run is {basename}.")
-    logger.info(f"Current ram usage (GB): {psutil.virtual_memory()[3]/1000000000:.2f}")
-    logger.info(f"Current cpu usage (%): {psutil.cpu_percent(4):.1f}")
-    
-    if config['general']['compress_output'] == 'True':
-        image_dir = tar_file.replace(".tar.gz", "") # remove extension
-    else:
-        image_dir = tar_file.replace(".tar", "") # remove extension
-        
-    tar_identifier = os.path.basename(image_dir)
-    tmp_dir = fast_scratch + '/' + tar_identifier
-    os.makedirs(tmp_dir, permis, exist_ok = True)
-    
-    log_file = f"{classification_dir}/{tar_identifier}.log"
-    image_dir = tmp_dir + '/'
+# [classification] settings that change the results written for a tar.
+CLASSIFY_SETTINGS = ['scnn_dir', 'scnn_cmd']
 
-    gpu_id = queue.get()
+# Rough size of a crop, used to estimate the crop count of compressed tars without reading them.
+BYTES_PER_CROP = 20000
 
-    logger.info(f"Starting on GPU {gpu_id}")
-    logger.info(f'image_dir: {tmp_dir}')
-    logger.info(f'tar_identifier: {tar_identifier}')
-    
-    # Untar files
-    if config['general']['compress_output'] == 'True':
-        untar_cmd = f'tar -xzf "{tar_file}" -C "{tmp_dir}" --strip-components=4 --wildcards "*crop*.png"  >> "{log_file}" 2>&1' # TBK change strip-components to what you need.
-        logger.debug('Untarring+unzipping files: ' + untar_cmd)
+
+def model_name():
+    """Model identifier stored in the manifest: basename and epoch."""
+    return f"{basename}_epoch-{epoch}"
+
+
+def pending(tars):
+    """The tars that do not have a complete, up to date csv in classification_dir."""
+    entries = manifest.load(classification_dir)
+    return [tar for tar in tars if not manifest.is_complete(entries, tar, manifest.signature(tar, settings_hash, model_name()))]
+
+
+def tar_identifier(tar_file):
+    """Name of a tar without directory or extension, used for the scratch dir, log and csv."""
+    return archive.strip_extension(tar_file)
+
+
+def count_crops(tar_file):
+    """Number of crops in a tar; estimated from the file size for compressed tars without an index."""
+    index = archive.read_index(tar_file)
+    if index is not None:
+        return len(fnmatch.filter(index, '*crop*.png'))
+    if archive.detect(tar_file) != 'none':
+        return os.path.getsize(tar_file) // BYTES_PER_CROP
+    with tarfile.open(tar_file) as tar:
+        return sum([1 for name in tar.getnames() if 'crop' in name and name.endswith('.png')])
+
+
+def plan_tars(tars, workers, logs = ()):
+    """Order tars longest-first and print the predicted run time and peak scratch.
+
+    Costs are crop counts scaled by the timer_scnn times logged by earlier runs
+    in classification_dir (and any extra logs). Each tar is extracted to scratch, so its footprint is
+    about its own size.
+    """
+    logs = glob.glob(glob.escape(classification_dir) + '/classification_*.log') + list(logs)
+    timings = scheduler.logged_timings(logs, 'tar_identifier:', 'SCNN took')
+    costs, rate = scheduler.estimate_costs(tars, count_crops, tar_identifier, timings)
+
+    plan = scheduler.summary(costs, rate, workers, [os.path.getsize(tar) for tar in tars], 'crops')
+    logger.info(plan)
+    print(plan)
+    return scheduler.longest_first(tars, costs)
+
+
+def extract_crops(tar_file, dest, log_file):
+    """Extract the crops of a tar into dest (flattened) and return their file names."""
+    os.makedirs(dest, permis, exist_ok = True)
+
+    # Untar files, the format is detected from the file so compress_output does not have to match segmentation.
+    untar_cmd = f'tar {archive.extract_option(tar_file)} -xf "{tar_file}" -C "{dest}" --strip-components=4 --wildcards "*crop*.png"  >> "{log_file}" 2>&1' # TBK change strip-components to what you need.
+
+    timer_untar = time()
+    index = archive.read_index(tar_file)
+    if index is not None and archive.detect(tar_file) == 'none':
+        # Read the crops straight from their offsets instead of scanning the whole tar.
+        n_crops = len(archive.extract_members(tar_file, fnmatch.filter(index, '*crop*.png'), dest))
+        logger.debug(f'Extracted {n_crops} crops using the tar index.')
     else:
-        untar_cmd = f'tar -xf "{tar_file}" -C "{tmp_dir}" --strip-components=4 --wildcards "*crop*.png"  >> "{log_file}" 2>&1' # TBK change strip-components to what you need.
         logger.debug('Untarring files: ' + untar_cmd)
-    
-    timer_untar = time()
-    os.system(untar_cmd)
+        os.system(untar_cmd)
     timer_untar = time() - timer_untar
     logger.debug(f"Untarring files took {timer_untar:.3f} s.")
 
+    return [f for f in os.listdir(dest) if os.path.isfile(os.path.join(dest, f))]
+
+
+def model_header():
+    """csv header SCNN writes for the model, for results written without running it.
+
+    Taken from the cache, a finished result of the same model in classification_dir,
+    or else classList (first field of every line).
+    """
+    if crop_cache is not None:
+        header = crop_cache.header(f"{model_name()}/{settings_hash}")
+        if header is not None:
+            return header
+    for entry in manifest.load(classification_dir).values():
+        sig = entry['signature']
+        if sig['model'] == model_name() and sig['config'] == settings_hash and os.path.isfile(entry['output']):
+            return ['fileName'] + list(results.load(entry['output'])[1])
+    with open(scnn_directory + '/data/classList') as f:
+        return ['fileName'] + [line.split()[0] for line in f if line.strip() != '']
+
+
+def write_empty(image_dir):
+    """Write the header-only csv of a run without crops and return its path."""
+    csv_path = image_dir + '.csv'
+    with open(csv_path, 'w', newline = '') as f:
+        csv.writer(f).writerow(model_header())
+    return csv_path
+
+
+def run_scnn(image_dir, gpu_id, log_file):
+    """Run SCNN over image_dir and return the path of the csv it wrote, or None."""
+    run_id = os.path.basename(image_dir)
+
     # Perform classification.
-    #scnn_cmd  = f"cd '{os.path.dirname(scnn_command)}'; nohup ./scnn -start {epoch} -stop {epoch} -unl '{tmp_dir}' -cD {gpu_id} -basename {basename} >> '{log_file}' 2>&1"
-    scnn_cmd  = f"nohup {scnn_command} -start {epoch} -stop {epoch} -unl '{tmp_dir}' -bs {batchsize} -cD {gpu_id} -basename {basename} -project {scnn_directory} >> '{log_file}' 2>&1"
+    #scnn_cmd  = f"cd '{os.path.dirname(scnn_command)}'; nohup ./scnn -start {epoch} -stop {epoch} -unl '{image_dir}' -cD {gpu_id} -basename {basename} >> '{log_file}' 2>&1"
+    scnn_cmd  = f"nohup {scnn_command} -start {epoch} -stop {epoch} -unl '{image_dir}' -bs {batchsize} -cD {gpu_id} -basename {basename} -project {scnn_directory} >> '{log_file}' 2>&1"
     logger.debug('Running SCNN: ' + scnn_cmd)
     logger.info('Start SCNN.')
 
@@ -96,26 +172,233 @@ def classify(tar_file):
     logger.info('End SCNN.')
     logger.debug(f"SCNN took {timer_scnn:.3f} s.")
 
-    # Move the csv file resulting from classification.
-    logger.info(f"Looking for files in {scnn_directory}/data/ that match the id: {tar_identifier}")
-    csv_path = glob.glob(f"{scnn_directory}/data/*{tar_identifier}*")
-    if len(csv_path) > 0:
-        csv_path = csv_path[0]
-        csv_file = f"{classification_dir}/{tar_identifier}.csv"
-
-        timer_move = time()
-        shutil.move(csv_path, csv_file)
-        os.chmod(csv_file, permis)
-        timer_move = time() - timer_move
-        logger.debug(f"Moving csv(s) took {timer_move:.3f} s.")
-        
+    logger.info(f"Looking for files in {scnn_directory}/data/ that match the id: {run_id}")
+    csv_path = glob.glob(f"{scnn_directory}/data/*{run_id}*")
+    if len(csv_path) == 0:
+        return None
+    return csv_path[0]
+
+
+def collapse(image_dir, sources):
+    """Remove near-duplicate crops from image_dir before SCNN.
+
+    sources maps each crop file name to (tar, name in the tar) for the frame
+    numbers. Returns {removed crop: representative crop}.
+    """
+    timer_dedupe = time()
+    names = os.listdir(image_dir)
+    hashes = dedupe.hash_all([os.path.join(image_dir, name) for name in names], dedupe_threads)
+    hashes = {os.path.basename(path): h for path, h in hashes.items()}
+
+    frames = {}
+    for name in names:
+        tar_file, original = sources[name]
+        frame = catalog.frame_number(original, tar_identifier(tar_file))
+        frames[name] = None if frame is None else (tar_file, frame)
+
+    members = dedupe.group(hashes, frames, dedupe_window, dedupe_distance)
+    for name in members:
+        os.remove(os.path.join(image_dir, name))
+    logger.info(f"Collapsed {len(members)} of {len(names)} near-duplicate crops.")
+    logger.debug(f"Collapsing took {time() - timer_dedupe:.3f} s.")
+    dedupe.report(dedupe.report_path(classification_dir, session_id), os.path.basename(image_dir), len(names), len(members))
+    return members
+
+
+def expand(csv_path, members):
+    """Add a copy of its representative's row for every collapsed crop to csv_path."""
+    with open(csv_path, newline = '') as f:
+        rows = [row for row in csv.reader(f) if len(row) > 0]
+
+    by_name = {os.path.basename(row[0]): row for row in rows[1:]}
+    for name, rep_name in members.items():
+        if rep_name in by_name:
+            row = by_name[rep_name]
+            rows.append([row[0][:-len(rep_name)] + name] + row[1:])
+        else:
+            logger.warning(f"No result for {rep_name}, the representative of {name}.")
+
+    with open(csv_path, 'w', newline = '') as f:
+        csv.writer(f).writerows(rows)
+
+
+def run_cached(image_dir, gpu_id, log_file):
+    """run_scnn on only the crops of image_dir that are not in the cache; returns a csv covering all crops, or None.
+
+    SCNN is not run at all if image_dir is empty or every crop is cached.
+    """
+    if len(os.listdir(image_dir)) == 0: # nothing segmented, SCNN would write no results
+        logger.info(f"No crops in {os.path.basename(image_dir)}, writing an empty result without running SCNN.")
+        return write_empty(image_dir)
+    if crop_cache is None:
+        return run_scnn(image_dir, gpu_id, log_file)
+
+    model = f"{model_name()}/{settings_hash}"
+    timer_cache = time()
+    hashes = {name: cache.content_hash(os.path.join(image_dir, name)) for name in os.listdir(image_dir)}
+    hits = crop_cache.get(model, hashes.values())
+    for name, h in hashes.items():
+        if h in hits:
+            os.remove(os.path.join(image_dir, name)) # SCNN only sees the misses
+    n_hits = len([h for h in hashes.values() if h in hits])
+    logger.info(f"Cache: {n_hits} of {len(hashes)} crops already classified by {model_name()}.")
+    logger.debug(f"Cache lookup took {time() - timer_cache:.3f} s.")
+
+    header = None
+    rows = []
+    if n_hits == len(hashes):
+        header = model_header() # the header cached with the rows, or else classList
     else:
-        logger.error(f'No classification file found for {tar_identifier}')
-
-    # Clean directories to make space.
-    #shutil.rmtree(tmp_dir)
+        csv_path = run_scnn(image_dir, gpu_id, log_file)
+        if csv_path is None:
+            return None
+        with open(csv_path, newline = '') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            rows = [row for row in reader if len(row) > 0]
+        os.remove(csv_path)
+        crop_cache.put(model, header, {hashes[os.path.basename(row[0])]: row[1:] for row in rows if os.path.basename(row[0]) in hashes})
+
+    rows += [[os.path.join(image_dir, name)] + hits[h] for name, h in hashes.items() if h in hits]
+    csv_path = image_dir + '.csv'
+    with open(csv_path, 'w', newline = '') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return csv_path
+
+
+def split_results(csv_path, owners, sigs):
+    """Split the csv of a batch into one csv per tar in classification_dir.
+
+    owners maps the file name each crop had during the run to (tar, original name).
+    """
+    rows = {tar_file: [] for tar_file in sigs}
+    with open(csv_path, newline = '') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        for row in reader:
+            name = os.path.basename(row[0])
+            if name not in owners:
+                logger.warning(f'Result for unknown image {row[0]} in {csv_path}')
+                continue
+            tar_file, original = owners[name]
+            if original != name: # renamed to avoid a clash with a crop from another tar
+                row[0] = row[0][:-len(name)] + original
+            rows[tar_file].append(row)
+
+    for tar_file in sigs:
+        csv_file = f"{classification_dir}/{tar_identifier(tar_file)}.csv"
+        with open(csv_file + '.part', 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows[tar_file])
+        os.replace(csv_file + '.part', csv_file)
+        finish_output(tar_file, sigs[tar_file], csv_file)
+    os.remove(csv_path)
+
+
+def finish_output(tar_file, sig, csv_file):
+    """Write the results_format outputs of a finished csv and record the tar as done."""
+    output = csv_file
+    if results_format != 'csv':
+        output = results.convert(csv_file, results_dtype, remove = results_format == 'npy')
+        os.chmod(results.prefix(output) + '.json', permis)
+    os.chmod(output, permis)
+    catalog.add_result(segmentation_dir, tar_file, output, results.load(output)[0])
+    manifest.record(classification_dir, tar_file, sig, output)
+
+
+def batch_tars(tars, max_crops):
+    """Group tars with fewer than max_crops crops into batches of up to max_crops crops.
+
+    Large tars stay single jobs; small ones are packed first-fit into lists so
+    one SCNN process (one model load and GPU setup) handles several of them.
+    """
+    jobs = []
+    batches = [] # [crops, [tars]]
+    for tar_file in tars:
+        n_crops = count_crops(tar_file)
+        if n_crops >= max_crops:
+            jobs.append(tar_file)
+            continue
+        for batch in batches:
+            if batch[0] + n_crops <= max_crops:
+                batch[0] += n_crops
+                batch[1].append(tar_file)
+                break
+        else:
+            batches.append([n_crops, [tar_file]])
+
+    return jobs + [batch[1] if len(batch[1]) > 1 else batch[1][0] for batch in batches]
+
+
+def classify(job, gpu_id):
+    """Classify images contained within a TAR file, or within a list of TAR files in one SCNN run, on GPU gpu_id."""
+    
+    tars = job if isinstance(job, list) else [job]
+    timer_classify = time()
+    logger.info("Starting classify")
+    sigs = {tar_file: manifest.signature(tar_file, settings_hash, model_name()) for tar_file in tars}
+    logger.debug(f"Basename for model run is {basename}.")
+    logger.info(f"Current ram usage (GB): {psutil.virtual_memory()[3]/1000000000:.2f}")
+    
+    run_id = tar_identifier(tars[0])
+    if len(tars) > 1:
+        run_id = f"batch-{run_id}"
+    log_file = f"{classification_dir}/{run_id}.log"
+
+    # Wait for room on scratch for the extracted crops (RAM first, then the spill locations).
+    # Released when the block exits, also if the job fails: pool workers outlive their jobs, so a leaked entry never goes stale.
+    with scratch_space.job(run_id, sum([count_crops(tar_file) for tar_file in tars]) * BYTES_PER_CROP, logger) as tmp_dir:
+        logger.info(f"Starting on GPU {gpu_id}")
+        logger.info(f'image_dir: {tmp_dir}')
+        logger.info(f'tar_identifier: {run_id}')
+
+        owners = {} # crop file name in tmp_dir -> (tar, name in the tar)
+        if len(tars) == 1:
+            extract_crops(tars[0], tmp_dir, log_file)
+        else:
+            logger.info(f'Batch of {len(tars)} tars: {", ".join([tar_identifier(tar_file) for tar_file in tars])}')
+            for tar_file in tars:
+                stage = tmp_dir + '/' + tar_identifier(tar_file)
+                for name in extract_crops(tar_file, stage, log_file):
+                    new_name = name if name not in owners else f"{tar_identifier(tar_file)}_{name}"
+                    os.rename(stage + '/' + name, tmp_dir + '/' + new_name)
+                    owners[new_name] = (tar_file, name)
+                shutil.rmtree(stage)
+
+        members = {}
+        if dedupe_window > 0:
+            if len(tars) == 1:
+                owners = {name: (tars[0], name) for name in os.listdir(tmp_dir)}
+            members = collapse(tmp_dir, owners)
+
+        csv_path = run_cached(tmp_dir, gpu_id, log_file)
+        if csv_path is not None and len(members) > 0:
+            expand(csv_path, members)
+
+        # Move the csv file resulting from classification.
+        if csv_path is None:
+            logger.error(f'No classification file found for {run_id}')
+            raise RuntimeError(f'SCNN wrote no results for {run_id} on GPU {gpu_id}, see {log_file}') # counted against the GPU by the dispatcher
+
+        if len(tars) == 1:
+            csv_file = f"{classification_dir}/{run_id}.csv"
+
+            timer_move = time()
+            shutil.move(csv_path, csv_file + '.part') # renamed once fully copied so a partial csv is never trusted
+            os.replace(csv_file + '.part', csv_file)
+            finish_output(tars[0], sigs[tars[0]], csv_file)
+            timer_move = time() - timer_move
+            logger.debug(f"Moving csv(s) took {timer_move:.3f} s.")
+
+        else:
+            timer_move = time()
+            split_results(csv_path, owners, sigs)
+            timer_move = time() - timer_move
+            logger.debug(f"Splitting csv into {len(tars)} files took {timer_move:.3f} s.")
 
-    queue.put(gpu_id) # add the gpu id to the queue so that it can be allocated again
     logger.debug('End classify.')
     timer_classify = time() - timer_classify
     logger.debug(f"Total classification process took {timer_classify:.3f} s.")
@@ -132,6 +415,49 @@ def classify(tar_file):
     #    logger.debug(f"Preprocessing took {timer_pre:.3f} s.")
 
 
+def configure(cfg, directory, sid):
+    """Set the module level settings used by classify from a parsed config.
+
+    directory is the segmentation directory holding the tars. Called from
+    __main__ and from plankline.py when classification runs alongside
+    segmentation.
+    """
+    global config, session_id, basename, permis, scnn_instances, scnn_directory, scnn_command
+    global epoch, fast_scratch, batchsize, segmentation_dir, classification_dir, resume, settings_hash, batch_crops, results_format, results_dtype, results_store, scratch_space, crop_cache
+    global dedupe_window, dedupe_distance, dedupe_threads
+    config = cfg
+    session_id = sid
+
+    basename = config['classification']['scnn_basename']
+    permis = int(config['general']['dir_permissions'])
+    scnn_instances = int(config['classification']['scnn_instances'])
+    scnn_directory = config['classification']['scnn_dir']
+    scnn_command = config['classification']['scnn_cmd']
+    epoch = int(config['classification']['epoch'])
+    fast_scratch = config['classification']['fast_scratch']
+    batchsize = config['classification']['batchsize']
+    batch_crops = int(config['classification'].get('batch_crops', fallback = '0'))
+    results_format = config['classification'].get('results_format', fallback = 'csv')
+    results_dtype = config['classification'].get('results_dtype', fallback = 'float16')
+    results_store = config['classification'].getboolean('results_store', fallback = False)
+    dedupe_window = int(config['classification'].get('dedupe_window', fallback = '0'))
+    dedupe_distance = int(config['classification'].get('dedupe_distance', fallback = '4'))
+    dedupe_threads = int(config['classification'].get('dedupe_threads', fallback = '8'))
+    crop_cache = None
+    if config['classification'].get('cache', fallback = '').strip() != '':
+        crop_cache = cache.Cache(config['classification']['cache'].strip(), scratch.parse_size(config['classification'].get('cache_size', fallback = '0')))
+    if results_format not in ['csv', 'npy', 'both']:
+        raise ValueError(f"Unknown results_format {results_format}, use csv, npy or both")
+    resume = config['general'].getboolean('resume', fallback = False)
+    settings_hash = manifest.config_hash(config, 'classification', CLASSIFY_SETTINGS)
+
+    segmentation_dir = os.path.abspath(directory)  # /media/plankline/Data/analysis/segmentation/Camera1/Transect1 (reg)
+    classification_dir = segmentation_dir.replace('segmentation', 'classification')  # /media/plankline/Data/analysis/segmentation/Camera1/Transect1 (reg)
+    classification_dir = classification_dir.replace(')', f'-{basename})')  # /media/plankline/Data/analysis/segmentation/Camera1/Transect1 (reg plankton)
+    fast_scratch = fast_scratch + "/classify-" + session_id
+    scratch_space = scratch.from_config(config, 'classification', "classify-" + session_id, permis)
+
+
 if __name__ == "__main__":
     """Main entry point for classification.py"""
     
@@ -149,19 +475,7 @@ if __name__ == "__main__":
     config = configparser.ConfigParser()
     config.read(args.config)
     
-    basename = config['classification']['scnn_basename']
-    permis = int(config['general']['dir_permissions'])
-    scnn_instances = int(config['classification']['scnn_instances'])
-    scnn_directory = config['classification']['scnn_dir']
-    scnn_command = config['classification']['scnn_cmd']
-    epoch = int(config['classification']['epoch'])
-    fast_scratch = config['classification']['fast_scratch']
-    batchsize = config['classification']['batchsize']
-
-    segmentation_dir = os.path.abspath(args.directory)  # /media/plankline/Data/analysis/segmentation/Camera1/Transect1 (reg)
-    classification_dir = segmentation_dir.replace('segmentation', 'classification')  # /media/plankline/Data/analysis/segmentation/Camera1/Transect1 (reg)
-    classification_dir = classification_dir.replace(')', f'-{basename})')  # /media/plankline/Data/analysis/segmentation/Camera1/Transect1 (reg plankton)
-    fast_scratch = fast_scratch + "/classify-" + session_id
+    configure(config, args.directory, session_id)
     
     os.makedirs(classification_dir, permis, exist_ok = True)
     os.makedirs(fast_scratch, permis, exist_ok = True)
@@ -217,45 +531,71 @@ if __name__ == "__main__":
     if not os.path.isfile(epoch_path):
         logger.error(f'Epoch file does not exist: {epoch_path}')
     
-    if config['general']['compress_output'] == 'True':
-        tars = [os.path.join(segmentation_dir, tar) for tar in os.listdir(segmentation_dir) if tar.endswith(".tar.gz")]
-    else :
-        tars = [os.path.join(segmentation_dir, tar) for tar in os.listdir(segmentation_dir) if tar.endswith(".tar")]
+    tars = [os.path.join(segmentation_dir, tar) for tar in os.listdir(segmentation_dir) if archive.is_archive(tar)]
 
     if len(tars) == 0:
         sys.exit("Error: No tars file in segmenation directory")
 
-    # setup gpu queue
-    num_gpus = str(subprocess.check_output(["nvidia-smi", "-L"])).count('UUID') # read number of gpus from nvidia-smi output
-
-    queue = Queue()
-    for gpu_id in range(num_gpus):
-        for _ in range(scnn_instances):
-            queue.put(gpu_id)
-
-    num_processes = scnn_instances * num_gpus
+    if resume:
+        n_tars = len(tars)
+        tars = pending(tars)
+        logger.info(f"Resuming: {n_tars - len(tars)} tar files already classified.")
+        print(f"Resuming: skipping {n_tars - len(tars)} tar files that are already classified.")
+
+    # GPUs from the config or nvidia-smi; each job is started on whichever GPU has a free slot.
+    gpus = devices.from_config(config, 'classification')
+    num_gpus = len(gpus)
+    num_processes = gpus.capacity()
+    if num_processes == 0:
+        sys.exit("Error: No GPU with enough free memory for an SCNN instance")
+    tars = plan_tars(tars, num_processes)
     tar_length = len(tars)
+    jobs = tars
+    if batch_crops > 0:
+        jobs = batch_tars(tars, batch_crops)
+        logger.info(f"Grouped {tar_length} tars into {len(jobs)} SCNN runs of up to {batch_crops} crops.")
+        print(f"Grouped {tar_length} tars into {len(jobs)} SCNN runs.")
     logger.debug(f"Number of GPUs: {num_gpus}")
     logger.debug(f"SCNN Instances per GPU: {scnn_instances}")
     logger.debug(f"Total Processes: {num_processes}")
+    logger.debug(f"GPU free memory (MB): {gpus.free}")
     logger.info(f"Identified {tar_length} tar.gz files")
 
     # this is the parallel portion of the code
     p = Pool(num_processes)
 
+    # Resource usage is sampled from this process so the workers never block on it.
+    sampler = monitor.Sampler(classification_dir, 'classification', session_id, float(config['general'].get('monitor_interval', fallback = '0')), fast_scratch)
+    sampler.start()
+
     # Start the Classification processes.
     timer_pool = time()
-    for _ in tqdm.tqdm(p.imap_unordered(classify, tars, chunksize = 1), total = len(tars)):
-        pass
+    dispatcher = devices.Dispatcher(p, gpus, classify)
+    for job in jobs:
+        dispatcher.submit(job)
+    try:
+        for job, error in tqdm.tqdm(dispatcher.drain(), total = len(jobs)):
+            if error is not None:
+                logger.error(f"Classification of {job} failed: {error!r}")
+    except RuntimeError as e: # every GPU disabled; still store what finished and clean up
+        logger.error(f"Classification stopped: {e}")
+        print(f"Classification stopped: {e}")
 
     p.close()
     p.join() # blocks so that we can wait for the processes to finish
+    sampler.stop()
     
     timer_pool = time() - timer_pool
     logger.debug(f"Finished classification in {timer_pool:.3f} seconds.")
     print(f"Finished Classification in {timer_pool:.1f} seconds.")
 
+    if results_store:
+        timer_store = time()
+        n_added = store.update(classification_dir)
+        logger.info(f"Added {n_added} tars to {store.store_path(classification_dir)} in {time() - timer_store:.3f} s.")
+
     logger.debug(f"Deleting temporary directory {fast_scratch}.")
     shutil.rmtree(fast_scratch, ignore_errors=True)
+    scratch_space.remove_all()
 
 
@@ -35,12 +35,15 @@ import argparse
 import configparser # TBK: To read config file
 import glob
 
+import scratch
+
 if __name__ == "__main__":
     """Main entry point for cleanup.py"""
     v_string = "V2023.09s.05"
 
     # create a parser for command line arguments
     parser = argparse.ArgumentParser(description="")
+    parser.add_argument("-c", "--config", required = False, help = "Configuration ini file, to look in its scratch locations instead of /tmp.")
     parser.add_argument("-d", "--directory", required = False, help = "Input directory containing ./raw/")
     parser.add_argument("-f", action = 'store_true')
 
@@ -56,11 +59,35 @@ if __name__ == "__main__":
     if not skip_working:
         working_dir = os.path.abspath(args.directory)
     
-    seg_tmp = glob.glob('/tmp/segment*')
-    class_tmp = glob.glob('/tmp/class*')
-    train_tmp = glob.glob('/tmp/train*')
+    scratch_roots = ['/tmp']
+    if args.config is not None:
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        scratch_roots = []
+        for section in ['segmentation', 'classification', 'training']:
+            if config.has_option(section, 'fast_scratch'):
+                scratch_roots += [r for r in scratch.roots(config, section) if r not in scratch_roots]
+
+    seg_tmp = []
+    class_tmp = []
+    train_tmp = []
+    for root in scratch_roots:
+        seg_tmp += glob.glob(root + '/segment*')
+        class_tmp += glob.glob(root + '/class*')
+        train_tmp += glob.glob(root + '/train*')
+
+    # Space held by running jobs, and reservations left behind by crashed ones.
+    for root in scratch_roots:
+        live, stale = scratch.usage(root)
+        for key, entry in live.items():
+            print(f"Reserved:  {os.path.join(root, key):30} {entry['bytes']/10**9:.1f} GB by running process {entry['pid']}")
+        for key, entry in stale.items():
+            print(f"Stale:     {os.path.join(root, key):30} {entry['bytes']/10**9:.1f} GB by exited process {entry['pid']}")
 
     if args.f is True:
+        for root in scratch_roots:
+            scratch.prune(root)
+
         if not skip_working:
             if os.path.isdir(working_dir + '/segmentation/'):
                 shutil.rmtree(working_dir + '/segmentation/', ignore_errors = True)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""Near-duplicate crop collapsing for UAF-Plankline
+    Frame overlap and slow moving organisms give long runs of nearly
+    identical crops. Before SCNN, classify can hash every crop with a
+    difference hash (dHash, 64 bits from a 9x8 grayscale thumbnail) and group
+    crops of the same tar that are from different frames at most a few
+    frames apart, a few bits apart and of about the same width and height
+    (dHash ignores size). Crops of the same frame are always different
+    organisms. Only the first crop of each group is classified; the others
+    get a copy of its result row.
+
+    Requires Pillow, which is only imported when collapsing is enabled.
+
+Usage:
+    import dedupe
+    hashes = dedupe.hash_all(paths, threads)
+    members = dedupe.group(hashes, frames, window, distance)
+    dedupe.report(dedupe.report_path(out_dir, date), run_id, n_crops, len(members))
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+from multiprocessing.pool import ThreadPool
+
+REPORT_DIR = 'dedupe'
+
+
+def dhash(im, size = 8):
+    """size*size bit difference hash of a PIL image: is each pixel brighter than its right neighbour."""
+    from PIL import Image # only needed when collapsing is enabled
+
+    pixels = list(im.convert('L').resize((size + 1, size), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            i = row * (size + 1) + col
+            bits = (bits << 1) | (pixels[i] > pixels[i + 1])
+    return bits
+
+
+def fingerprint(path):
+    """(dhash, width, height) of an image file."""
+    from PIL import Image
+
+    with Image.open(path) as im:
+        return (dhash(im),) + im.size
+
+
+def hash_all(paths, threads = 8):
+    """{path: (dhash, width, height)} using a pool of threads (image decoding releases the GIL)."""
+    with ThreadPool(threads) as pool:
+        return dict(zip(paths, pool.map(fingerprint, paths)))
+
+
+def distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def similar_size(a, b, tolerance):
+    """True if the (width, height) of a and b each differ by at most tolerance of the larger one."""
+    return all([abs(x - y) <= tolerance * max(x, y) for x, y in zip(a, b)])
+
+
+def group(hashes, frames, window = 2, max_distance = 4, size_tolerance = 0.2):
+    """{crop: representative} for every crop that duplicates an earlier one.
+
+    hashes maps each crop to (dhash, width, height). frames maps each crop to
+    (source, frame) or None if its frame is unknown; crops are only compared
+    with representatives from the same source 1 to window frames earlier
+    whose width and height are within size_tolerance. Crops that are not in
+    the result represent themselves.
+    """
+    members = {}
+    active = {} # source -> [(frame, (dhash, width, height), crop)] representatives still inside the window
+    for crop in sorted([c for c in hashes if frames.get(c) is not None], key = lambda c: frames[c][1]):
+        source, frame = frames[crop]
+        h, width, height = hashes[crop]
+        reps = [rep for rep in active.get(source, []) if frame - rep[0] <= window]
+        for rep_frame, (rep_hash, rep_width, rep_height), rep in reps:
+            if rep_frame == frame: # two crops of one frame are two organisms
+                continue
+            if distance(h, rep_hash) <= max_distance and similar_size((width, height), (rep_width, rep_height), size_tolerance):
+                members[crop] = rep
+                break
+        else:
+            reps.append((frame, hashes[crop], crop))
+        active[source] = reps
+    return members
+
+
+def report_path(out_dir, date):
+    """Collapse report of a run, in its own subdirectory so it is not taken for a result csv."""
+    return os.path.join(out_dir, REPORT_DIR, f"dedupe_{date}.csv")
+
+
+def report(path, run_id, n_crops, n_collapsed):
+    """Append one line to the collapse report; single writes so workers can share the file."""
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        os.write(fd, b'run,crops,collapsed,classified\n')
+        os.close(fd)
+    except FileExistsError:
+        pass
+
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, f"{run_id},{n_crops},{n_collapsed},{n_crops - n_collapsed}\n".encode('utf-8'))
+    finally:
+        os.close(fd)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""GPU device scheduling for UAF-Plankline
+    Hands GPU jobs (SCNN classification, training runs) to a process pool one
+    at a time, each on whichever device has a free slot. Nothing is queued on
+    a device ahead of time: the parent only starts a job when a slot frees up,
+    so a slow GPU never holds work that a faster one could take. Slots are
+    returned from the pool's result callbacks, including when a job raises,
+    and a device that keeps failing is taken out of rotation.
+
+    Devices are listed in the config, or probed with a command printing
+    "index, free memory (MB)" per line (nvidia-smi by default). Any command
+    with that output can stand in for nvidia-smi, e.g. on a machine without
+    GPUs: device_probe = printf "0, 8000\n1, 8000\n"
+
+Usage:
+    import devices
+    gpus = devices.from_config(config, 'classification')
+    dispatcher = devices.Dispatcher(pool, gpus, function)
+    dispatcher.submit(job)
+    for job, error in dispatcher.drain():
+        ...
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import queue
+import subprocess
+from collections import deque
+
+PROBE_COMMAND = 'nvidia-smi --query-gpu=index,memory.free --format=csv,noheader,nounits'
+
+
+def probe(command = PROBE_COMMAND):
+    """{device id: free memory in MB} from the output of command."""
+    output = subprocess.run(command, shell = True, check = True, stdout = subprocess.PIPE, text = True).stdout
+    free = {}
+    for line in output.splitlines():
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) < 2 or not fields[0].isdigit():
+            continue
+        free[int(fields[0])] = float(fields[1])
+    return free
+
+
+def from_config(config, section, slots_key = 'scnn_instances'):
+    """Devices for one config section.
+
+    devices lists GPU ids to use (memory unknown); if blank, device_probe (or
+    nvidia-smi) is run. slots_key is the option giving jobs per device.
+    """
+    listed = config[section].get('devices', fallback = '').strip()
+    if listed != '':
+        free = {int(d): None for d in listed.split(',') if d.strip() != ''}
+    else:
+        free = probe(config[section].get('device_probe', fallback = PROBE_COMMAND))
+
+    slots = int(config[section].get(slots_key, fallback = '1'))
+    return Devices(free, slots,
+        memory = float(config[section].get('gpu_memory', fallback = '0')),
+        max_failures = int(config[section].get('max_failures', fallback = '3')))
+
+
+class Devices:
+    """Slots, in-flight jobs and memory headroom of every device."""
+
+    def __init__(self, free, slots = 1, memory = 0, max_failures = 3):
+        self.free = dict(free)       # id -> free MB when probed, or None if unknown
+        self.slots = slots           # concurrent jobs per device
+        self.memory = memory         # MB one job needs, 0 to ignore memory
+        self.max_failures = max_failures
+        self.in_flight = {d: 0 for d in self.free}
+        self.failures = {d: 0 for d in self.free}
+
+    def __len__(self):
+        return len(self.free)
+
+    def capacity(self):
+        """Number of jobs that can run at once over all usable devices."""
+        return sum([self._limit(d) for d in self.free])
+
+    def _limit(self, device):
+        if self.failures[device] >= self.max_failures:
+            return 0
+        if self.memory > 0 and self.free[device] is not None:
+            return min(self.slots, int(self.free[device] // self.memory))
+        return self.slots
+
+    def acquire(self):
+        """Id of the least loaded device with a free slot, or None if all are busy."""
+        usable = [d for d in self.free if self.in_flight[d] < self._limit(d)]
+        if len(usable) == 0:
+            return None
+        # least busy first, then most memory left
+        device = min(usable, key = lambda d: (self.in_flight[d], -(self.free[d] or 0)))
+        self.in_flight[device] += 1
+        return device
+
+    def release(self, device, failed = False):
+        self.in_flight[device] -= 1
+        if failed:
+            self.failures[device] += 1
+        else:
+            self.failures[device] = 0
+
+    def usable(self):
+        return [d for d in self.free if self._limit(d) > 0]
+
+
+class Dispatcher:
+    """Runs function(job, device) on a pool, starting each job when a device slot frees up."""
+
+    def __init__(self, pool, devices, function):
+        self.pool = pool
+        self.devices = devices
+        self.function = function
+        self.pending = deque()
+        self.running = 0
+        self._done = queue.Queue() # filled from the pool's result handler thread
+
+    def submit(self, job):
+        self.pending.append(job)
+        self._start()
+
+    def _start(self):
+        while len(self.pending) > 0:
+            device = self.devices.acquire()
+            if device is None:
+                break
+            job = self.pending.popleft()
+            self.pool.apply_async(self.function, (job, device),
+                callback = lambda _, job = job, device = device: self._done.put((job, device, None)),
+                error_callback = lambda e, job = job, device = device: self._done.put((job, device, e)))
+            self.running += 1
+
+    def _finish(self, block):
+        """Handle one finished job; returns (job, error) or None if none finished."""
+        try:
+            job, device, error = self._done.get(block)
+        except queue.Empty:
+            return None
+        self.running -= 1
+        self.devices.release(device, failed = error is not None)
+        self._start()
+        return job, error
+
+    def poll(self):
+        """Finished jobs as (job, error) without waiting."""
+        finished = []
+        while True:
+            result = self._finish(False)
+            if result is None:
+                return finished
+            finished.append(result)
+
+    def drain(self):
+        """Yield (job, error) for every job until all submitted jobs have finished."""
+        while self.running > 0 or len(self.pending) > 0:
+            if self.running == 0:
+                self._start()
+                if self.running == 0:
+                    raise RuntimeError(f"No usable devices left, {len(self.pending)} jobs not started.")
+            yield self._finish(True)
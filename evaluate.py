@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""Per-epoch evaluation for UAF-Plankline
+    Classifies a fixed validation set (one folder of images per taxon, like
+    a training set) with the weights of an epoch and records the top-1
+    accuracy and the throughput of SCNN in <basename>_eval.csv:
+
+        epoch, device, images, seconds, images_per_s, accuracy
+
+    train.py submits every epoch as soon as its weights are saved, so the
+    evaluation runs while the next epoch trains, and reports the best epoch
+    at the end. Evaluations run on their own GPUs ([training] eval_devices)
+    or share the training GPU, at most eval_jobs at a time per GPU. A sweep
+    shares one Evaluator between all of its runs, each epoch submitted with
+    the basename and out_file of its run, so the limit holds per machine.
+
+Usage:
+    import evaluate
+    evaluator = evaluate.Evaluator(scnn_cmd, project, basename, validation_dir, scratch_dir, gpus, batchsize, out_file)
+    evaluator.submit(epoch)
+    evaluator.submit(epoch, basename, out_file)    (another model in the same project)
+    best = evaluator.wait()
+    ./evaluate.py <scnn_cmd> <project> <basename> <validation dir> <epoch> [<epoch> ...]
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import csv
+import glob
+import shutil
+import logging
+import argparse
+import threading
+import subprocess
+import numpy as np
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+import devices
+import results
+
+FIELDS = ['epoch', 'device', 'images', 'seconds', 'images_per_s', 'accuracy']
+
+
+def validation_labels(validation_dir):
+    """{flat name: (taxon, path)} of every image in the <taxon>/<image> folders of validation_dir."""
+    labels = {}
+    for taxon in sorted(os.listdir(validation_dir)):
+        taxon_dir = os.path.join(validation_dir, taxon)
+        if not os.path.isdir(taxon_dir):
+            continue
+        for name in sorted(os.listdir(taxon_dir)):
+            labels[f"{taxon}__{name}"] = (taxon, os.path.abspath(os.path.join(taxon_dir, name)))
+    return labels
+
+
+def accuracy(csv_path, labels):
+    """(images, top-1 accuracy) of an SCNN csv against the taxa of labels."""
+    names, classes, probs = results.read_csv(csv_path)
+    if len(names) == 0:
+        return 0, 0.0
+    predicted = np.asarray(classes)[np.asarray(probs).argmax(axis = 1)]
+    truth = np.array([labels[os.path.basename(name)][0] if os.path.basename(name) in labels else '' for name in names])
+    return len(names), float((predicted == truth).mean())
+
+
+def best_epoch(out_file):
+    """Row of out_file with the highest accuracy, or None."""
+    if not os.path.isfile(out_file):
+        return None
+    with open(out_file, newline = '') as f:
+        rows = list(csv.DictReader(f))
+    return max(rows, key = lambda row: float(row['accuracy'])) if len(rows) > 0 else None
+
+
+class Evaluator:
+    """Evaluates epochs in background threads, each on a free slot of gpus."""
+
+    def __init__(self, scnn_cmd, project, basename, validation_dir, scratch_dir, gpus, batchsize, out_file, logger = logging.getLogger('sLogger')):
+        self.scnn_cmd = scnn_cmd
+        self.project = project          # where scnn saved the weights
+        self.basename = basename
+        self.scratch_dir = scratch_dir
+        self.gpus = gpus
+        self.batchsize = batchsize
+        self.out_file = out_file
+        self.logger = logger
+        self.labels = validation_labels(validation_dir)
+        self._lock = threading.Condition() # notified whenever a device is released
+        self._pool = ThreadPoolExecutor(max(1, gpus.capacity()))
+        self._futures = []
+
+    def submit(self, epoch, basename = None, out_file = None):
+        """Queue an evaluation of epoch; basename and out_file default to those of the evaluator."""
+        self._futures.append(self._pool.submit(self._run, epoch, basename or self.basename, out_file or self.out_file))
+
+    def _run(self, epoch, basename, out_file):
+        with self._lock:
+            device = self.gpus.acquire()
+            while device is None and len(self.gpus.usable()) > 0: # busy, not gone: wait for a release
+                self._lock.wait()
+                device = self.gpus.acquire()
+        if device is None:
+            self.logger.error(f"No usable GPU left to evaluate {basename} epoch {epoch}.")
+            return None
+        try:
+            row = self.evaluate(epoch, device, basename, out_file)
+        except Exception as e:
+            with self._lock:
+                self.gpus.release(device, failed = True)
+                self._lock.notify_all()
+            self.logger.error(f"Evaluation of {basename} epoch {epoch} failed: {e}")
+            raise
+        with self._lock:
+            self.gpus.release(device)
+            self._lock.notify_all()
+            self._record(row, out_file)
+        self.logger.info(f"{basename} epoch {epoch}: accuracy {row['accuracy']} on {row['images']} validation images ({row['images_per_s']} images/s).")
+        return row
+
+    def evaluate(self, epoch, device, basename = None, out_file = None):
+        """Classify the validation set with the weights of epoch on device; returns the row for out_file."""
+        basename = basename or self.basename
+        out_file = out_file or self.out_file
+        run_id = f"eval-{basename}-epoch{epoch:04d}"
+        image_dir = os.path.join(self.scratch_dir, run_id)
+        os.makedirs(image_dir, exist_ok = True)
+        for name, (taxon, path) in self.labels.items(): # links, so the set is not copied for every epoch
+            if not os.path.lexists(os.path.join(image_dir, name)):
+                os.symlink(path, os.path.join(image_dir, name))
+
+        log_file = os.path.join(os.path.dirname(out_file), run_id + '.log')
+        call = [self.scnn_cmd, '-start', str(epoch), '-stop', str(epoch), '-unl', image_dir, '-bs', str(self.batchsize),
+            '-cD', str(device), '-basename', basename, '-project', self.project]
+        timer_eval = time()
+        with open(log_file, 'a') as log:
+            subprocess.run(call, stdout = log, stderr = subprocess.STDOUT, check = True, start_new_session = True)
+        timer_eval = time() - timer_eval
+        shutil.rmtree(image_dir, ignore_errors = True)
+
+        found = glob.glob(os.path.join(self.project, 'data', f"*{run_id}*"))
+        if len(found) == 0:
+            raise RuntimeError(f"SCNN wrote no results for {run_id}, see {log_file}")
+        result = os.path.join(os.path.dirname(out_file), run_id + '.csv')
+        shutil.move(found[0], result) # kept for a closer look at the best epochs
+        n, acc = accuracy(result, self.labels)
+        return {'epoch': epoch, 'device': device, 'images': n, 'seconds': f"{timer_eval:.1f}",
+            'images_per_s': f"{n / timer_eval if timer_eval > 0 else 0:.1f}", 'accuracy': f"{acc:.4f}"}
+
+    def _record(self, row, out_file):
+        new = not os.path.isfile(out_file)
+        with open(out_file, 'a', newline = '') as f:
+            writer = csv.DictWriter(f, fieldnames = FIELDS)
+            if new:
+                writer.writeheader()
+            writer.writerow(row)
+
+    def wait(self):
+        """Wait for every submitted evaluation; returns the best row so far in out_file."""
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception:
+                pass # logged by _run
+        self._pool.shutdown()
+        return best_epoch(self.out_file)
+
+
+if __name__ == "__main__":
+    """Evaluate saved epochs after the fact."""
+
+    parser = argparse.ArgumentParser(description="Classifies a validation set (one folder per taxon) with saved epochs and writes <basename>_eval.csv.")
+    parser.add_argument("scnn_cmd", help = "SCNN executable.")
+    parser.add_argument("project", help = "SCNN project directory (with weights/).")
+    parser.add_argument("basename", help = "Model basename.")
+    parser.add_argument("validation", help = "Validation set, one folder of images per taxon.")
+    parser.add_argument("epochs", type = int, nargs = '+', help = "Epochs to evaluate.")
+    parser.add_argument("-d", "--devices", default = '0', help = "Comma separated GPU ids, this defaults to 0.")
+    parser.add_argument("-j", "--jobs", type = int, default = 1, help = "Evaluations at once per GPU, this defaults to 1.")
+    parser.add_argument("-b", "--batchsize", type = int, default = 300, help = "SCNN batch size, this defaults to 300.")
+    parser.add_argument("-s", "--scratch", default = '/tmp', help = "Scratch directory for the image links, this defaults to /tmp.")
+    args = parser.parse_args()
+
+    gpus = devices.Devices({int(d): None for d in args.devices.split(',')}, slots = args.jobs)
+    out_file = os.path.join(args.project, 'weights', args.basename + '_eval.csv')
+    evaluator = Evaluator(args.scnn_cmd, args.project, args.basename, args.validation, args.scratch, gpus, args.batchsize, out_file)
+    for epoch in args.epochs:
+        evaluator.submit(epoch)
+    best = evaluator.wait()
+    if best is not None:
+        print(f"Best epoch {best['epoch']}: accuracy {best['accuracy']} (all epochs in {out_file})")
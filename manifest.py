@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Completion manifests for UAF-Plankline
+    Every output directory keeps a manifest.jsonl with one line per finished
+    input. Each line records the input file's size and mtime, a hash of the
+    config settings that affect the output, the model basename/epoch (for
+    classification) and the size of the output that was written. A rerun
+    skips an input only if all of these still match and the output is still
+    there with the recorded size; anything missing, stale or partially written
+    is processed again.
+
+    Lines are appended with a single write so segmentation and classification
+    workers can record results concurrently. Later lines win.
+
+Usage:
+    import manifest
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import json
+import hashlib
+from time import time
+
+MANIFEST_NAME = 'manifest.jsonl'
+
+
+def config_hash(config, section, keys):
+    """Short hash of the listed keys from one config section."""
+    values = [f"{key}={config[section].get(key, fallback = '')}" for key in keys]
+    return hashlib.sha1('\n'.join(values).encode('utf-8')).hexdigest()[:16]
+
+
+def signature(input_path, settings, model = None):
+    """Everything about an input that decides whether its output is still valid."""
+    return {
+        'size': os.path.getsize(input_path),
+        'mtime': int(os.path.getmtime(input_path)),
+        'config': settings,
+        'model': model
+    }
+
+
+def load(directory):
+    """Read the manifest in directory into a dict keyed on input name."""
+    entries = {}
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return entries
+
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue # torn line from a crash, the input will be redone
+            entries[entry['input']] = entry
+    return entries
+
+
+def is_complete(entries, input_path, sig):
+    """True if input_path was finished with the same signature and its output is intact."""
+    entry = entries.get(os.path.basename(input_path))
+    if entry is None or entry['signature'] != sig:
+        return False
+
+    output = entry['output']
+    return os.path.isfile(output) and os.path.getsize(output) == entry['output_size']
+
+
+def record(directory, input_path, sig, output):
+    """Append a completion line for input_path once output has been fully written."""
+    entry = {
+        'input': os.path.basename(input_path),
+        'signature': sig,
+        'output': output,
+        'output_size': os.path.getsize(output),
+        'finished': int(time())
+    }
+    line = (json.dumps(entry) + '\n').encode('utf-8')
+
+    fd = os.open(os.path.join(directory, MANIFEST_NAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""Resource monitoring for UAF-Plankline
+    A background thread in the parent process that samples system and child
+    process usage at a fixed interval and writes two time series to the
+    monitor/ subdirectory of the run log's directory (kept apart from the
+    result csvs that pull_all.py -d reads):
+
+        monitor/<name>_resources_<date>.csv   cpu, ram, disk io and scratch usage
+        monitor/<name>_processes_<date>.csv   cpu, rss and io of every child process
+
+    Workers (local_main, classify, scnn) are never blocked by the sampling, and
+    the files can be used to size segment_processes and scnn_instances.
+
+Usage:
+    import monitor
+    sampler = monitor.Sampler(path, name, date, interval, scratch)
+    sampler.start()
+    ...
+    sampler.stop()
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import csv
+import shutil
+import threading
+import psutil
+from time import time
+
+MONITOR_DIR = 'monitor'
+
+
+class Sampler:
+    """Samples resource usage every interval seconds on a daemon thread."""
+
+    def __init__(self, path, name, date, interval = 5, scratch = '/tmp'):
+        self.interval = interval
+        self.scratch = scratch
+        self.monitor_dir = os.path.join(path, MONITOR_DIR)
+        self.resource_file = os.path.join(self.monitor_dir, f"{name}_resources_{date}.csv")
+        self.process_file = os.path.join(self.monitor_dir, f"{name}_processes_{date}.csv")
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._procs = {} # pid -> psutil.Process, kept so cpu_percent has a reference point
+
+    def start(self):
+        if self.interval > 0:
+            os.makedirs(self.monitor_dir, exist_ok = True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _children(self):
+        """Current child processes (pool workers and the executables they start)."""
+        children = psutil.Process().children(recursive = True)
+        current = {}
+        for p in children:
+            current[p.pid] = self._procs.get(p.pid, p)
+        self._procs = current
+        return list(current.values())
+
+    def _run(self):
+        psutil.cpu_percent(None) # first call only sets the reference point
+        last_io = psutil.disk_io_counters()
+
+        with open(self.resource_file, 'w', newline = '') as rf, open(self.process_file, 'w', newline = '') as pf:
+            resources = csv.writer(rf)
+            processes = csv.writer(pf)
+            resources.writerow(['time', 'cpu_percent', 'ram_used_gb', 'ram_percent', 'disk_read_mb', 'disk_write_mb', 'scratch_used_gb', 'scratch_free_gb', 'children'])
+            processes.writerow(['time', 'pid', 'name', 'cpu_percent', 'rss_mb', 'read_mb', 'write_mb'])
+
+            while not self._stop.wait(self.interval):
+                now = f"{time():.1f}"
+                ram = psutil.virtual_memory()
+                io = psutil.disk_io_counters()
+                scratch = shutil.disk_usage(self.scratch)
+                children = self._children()
+
+                resources.writerow([now,
+                    f"{psutil.cpu_percent(None):.1f}",
+                    f"{ram.used/10**9:.2f}",
+                    f"{ram.percent:.1f}",
+                    f"{(io.read_bytes - last_io.read_bytes)/10**6:.1f}",
+                    f"{(io.write_bytes - last_io.write_bytes)/10**6:.1f}",
+                    f"{scratch.used/10**9:.2f}",
+                    f"{scratch.free/10**9:.2f}",
+                    len(children)])
+                last_io = io
+
+                for p in children:
+                    try:
+                        with p.oneshot():
+                            try:
+                                pio = p.io_counters()
+                                read_mb, write_mb = f"{pio.read_bytes/10**6:.1f}", f"{pio.write_bytes/10**6:.1f}"
+                            except (psutil.AccessDenied, AttributeError):
+                                read_mb, write_mb = '', ''
+                            processes.writerow([now, p.pid, p.name(), f"{p.cpu_percent(None):.1f}", f"{p.memory_info().rss/10**6:.1f}", read_mb, write_mb])
+                    except (psutil.NoSuchProcess, psutil.ZombieProcess):
+                        continue
+
+                rf.flush()
+                pf.flush()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Pipelined segmentation and classification script for UAF-Plankline
+    Runs segmentation and classification at the same time. Each tar written by
+    segmentation.local_main is handed straight to classification.classify, so
+    the GPUs start working as soon as the first AVI is segmented instead of
+    waiting for the whole transect. Segmentation uses segment_processes workers
+    and classification uses scnn_instances workers per GPU, as in the two
+    standalone scripts.
+
+Usage:
+    ./plankline.py -c <config.ini> -d <project directory>
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import glob
+import shutil
+import argparse
+import logging
+import logging.config
+import configparser
+import tqdm
+import datetime
+from time import time
+import multiprocessing
+from multiprocessing import Pool
+
+import segmentation
+import classification
+import monitor
+import devices
+import store
+
+# Seconds between checks for finished classifications while segmentation runs.
+POLL_INTERVAL = 1
+
+
+if __name__ == "__main__":
+    """Main entry point for plankline.py"""
+
+    v_string = "V2023.10.05"
+    print(f"Starting Plankline Pipeline Script {v_string}")
+    session_id = str(datetime.datetime.now().strftime("%Y%m%d_%H%M%S")).replace(':', '')
+
+    # create a parser for command line arguments
+    parser = argparse.ArgumentParser(description="Runs segmentation and classification concurrently, classifying each tar as soon as it is written.")
+    parser.add_argument("-c", "--config", required = True, help = "Configuration ini file.")
+    parser.add_argument("-d", "--directory", required = True, help = "Input directory containing ./raw/")
+
+    # read in the arguments
+    args = parser.parse_args()
+
+    if os.path.isfile(args.config) == False:
+        print(f"No config file found called {args.config}. Aborting!")
+        exit()
+
+    config = configparser.ConfigParser()
+    config.read(args.config)
+
+    if config.has_option('logging', 'config') == False:
+        print(f"No logging:config specified in {args.config}. Aborting!")
+        exit()
+
+    segmentation.configure(config, args.directory, session_id)
+    classification.configure(config, segmentation.segment_dir, session_id)
+    permis = segmentation.permis
+
+    for d in [segmentation.segment_dir, segmentation.fast_scratch, classification.classification_dir, classification.fast_scratch]:
+        os.makedirs(d, permis, exist_ok = True)
+
+    ## Setup logger, shared by both stages.
+    logging.config.fileConfig(config['logging']['config'], defaults={'date':session_id,'path':segmentation.segment_dir,'name':'plankline'})
+    logger = logging.getLogger('sLogger')
+    segmentation.logger = logger
+    classification.logger = logger
+
+    logger.info(f"Starting plankline pipeline {v_string}")
+    for d in [segmentation.segment_dir, classification.classification_dir]:
+        cp_file = d + '/' + session_id + ' ' + os.path.basename(args.config)
+        logger.info(f"Copy config to {cp_file}")
+        shutil.copy2(args.config, cp_file)
+
+    # Check the permissions
+    for d in [segmentation.segment_dir, segmentation.fast_scratch, classification.classification_dir, classification.fast_scratch]:
+        if os.access(d, os.W_OK) == False:
+            logger.error(f"Cannot write to directory {d}!")
+            exit()
+
+    epoch_path = classification.scnn_directory + '/weights/' + classification.basename + '_epoch-' + str(classification.epoch) + '.cnn'
+    if not os.path.isfile(epoch_path):
+        logger.error(f'Epoch file does not exist: {epoch_path}')
+
+    avis = [os.path.join(segmentation.raw_dir, avi) for avi in os.listdir(segmentation.raw_dir) if avi.endswith(".avi")]
+    if (len(avis) == 0):
+        logger.error(f"No avi files found in {segmentation.raw_dir}.")
+        exit()
+
+    # Tars that are already segmented but still need to be classified.
+    tars = []
+    all_avis = avis
+    if segmentation.resume:
+        n_avis = len(avis)
+        todo = segmentation.pending(avis)
+        tars = classification.pending([segmentation.tar_path(avi) for avi in avis if avi not in todo])
+        avis = todo
+        print(f"Resuming: skipping {n_avis - len(avis)} segmented AVI files, {len(tars)} of them still need classification.")
+
+    gpus = devices.from_config(config, 'classification')
+    num_gpus = len(gpus)
+    num_segment = segmentation.num_processes
+    num_classify = gpus.capacity()
+    if num_classify == 0:
+        logger.error("No GPU with enough free memory for an SCNN instance.")
+        exit()
+
+    print(f"Configuration file: {args.config}")
+    print(f"Segmentation from: {segmentation.raw_dir}")
+    print(f"Segmentation to: {segmentation.segment_dir}")
+    print(f"Classification to: {classification.classification_dir}")
+    print(f"Model: {classification.basename} (epoch {classification.epoch})")
+    print(f"Found {len(avis)} AVI files.")
+    print(f"Segmentation processes: {num_segment}")
+    print(f"Classification processes: {num_classify} ({num_gpus} GPUs)")
+    logger.debug(f"Segmentation processes: {num_segment}")
+    logger.debug(f"Classification processes: {num_classify}")
+
+    # Longest jobs first in both stages.
+    seg_jobs = avis
+    if segmentation.shard_frames > 0:
+        seg_jobs = segmentation.shard_jobs(avis)
+    seg_jobs = segmentation.plan_jobs(seg_jobs, all_avis, num_segment)
+    tars = classification.plan_tars(tars, num_classify, logs = glob.glob(glob.escape(segmentation.segment_dir) + '/plankline_*.log'))
+
+    # Both pools run at once; every finished tar is queued for classification right away
+    # and started on the first GPU with a free slot.
+    seg_pool = Pool(num_segment)
+    class_pool = Pool(num_classify)
+    dispatcher = devices.Dispatcher(class_pool, gpus, classification.classify)
+
+    sampler = monitor.Sampler(segmentation.segment_dir, 'plankline', session_id, float(config['general'].get('monitor_interval', fallback = '0')), segmentation.fast_scratch)
+    sampler.start()
+
+    timer_pool = time()
+    failed = []
+    seg_failed = 0
+    for tar_name in tars:
+        dispatcher.submit(tar_name)
+    segmented = seg_pool.imap_unordered(segmentation.segment_job, segmentation.cut_shards(seg_jobs))
+    progress = tqdm.tqdm(total = len(seg_jobs), desc = 'Segmentation')
+    while progress.n < len(seg_jobs):
+        # Polled on a timeout too, so a GPU slot freed while segment runs is refilled right away.
+        failed += [job for job, error in dispatcher.poll() if error is not None]
+        try:
+            tar_name = segmented.next(timeout = POLL_INTERVAL)
+        except multiprocessing.TimeoutError:
+            continue
+        except StopIteration: # AVIs that could not be split into shards are left out
+            break
+        except Exception: # logged by segment_job; the other AVIs carry on
+            progress.update()
+            seg_failed += 1
+            continue
+        progress.update()
+        if tar_name is None: # shard of an AVI that is not complete yet
+            continue
+        logger.info(f"Queueing {tar_name} for classification.")
+        dispatcher.submit(tar_name)
+    progress.close()
+
+    seg_pool.close()
+    seg_pool.join()
+    logger.debug(f"Finished segmentation in {time() - timer_pool:.3f} s.")
+    if seg_failed > 0:
+        logger.error(f"{seg_failed} of {len(seg_jobs)} segmentation jobs failed.")
+
+    try:
+        for job, error in tqdm.tqdm(dispatcher.drain(), total = dispatcher.running + len(dispatcher.pending), desc = 'Classification'):
+            if error is not None:
+                failed.append(job)
+    except RuntimeError as e: # every GPU disabled; still store what finished and clean up
+        failed += list(dispatcher.pending)
+        logger.error(f"Classification stopped: {e}")
+    for job in failed:
+        logger.error(f"Classification of {job} failed.")
+
+    class_pool.close()
+    class_pool.join()
+    sampler.stop()
+
+    if classification.results_store:
+        n_added = store.update(classification.classification_dir)
+        logger.info(f"Added {n_added} tars to {store.store_path(classification.classification_dir)}.")
+
+    timer_pool = time() - timer_pool
+    logger.debug(f"Finished pipeline in {timer_pool:.3f} s.")
+    print(f"Finished segmentation and classification in {timer_pool:.1f} seconds.")
+
+    shutil.rmtree(segmentation.fast_scratch, ignore_errors=True)
+    shutil.rmtree(classification.fast_scratch, ignore_errors=True)
+    segmentation.scratch_space.remove_all()
+    classification.scratch_space.remove_all()
+    logger.debug("Done.")
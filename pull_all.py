@@ -32,9 +32,17 @@ import os
 import glob
 import argparse
 import csv # to parse all of the csv files
-import tarfile # untar the images
-import re
 import shutil # for copying files
+import fcntl # for reflinks
+import numpy as np
+from multiprocessing import Pool
+
+import archive
+import catalog
+import results
+import scratch
+import shards
+import store
 
 # arg types
 def directory(arg):
@@ -50,6 +58,10 @@ def csv_type(arg):
         raise argparse.ArgumentTypeError("Not a csv file")
     else:
          return arg
+def sqlite_type(arg):
+    if not os.path.isfile(arg):
+        raise argparse.ArgumentTypeError("Not a file")
+    return arg
 def float01(arg):
     if not float(arg):
         raise argparse.ArgumentTypeError("Not a floating point number")
@@ -60,21 +72,42 @@ def float01(arg):
         return arg
 
 # check to make sure the image doesn't already exist. Some images in different tars are given the same name
-def add_unique_postfix(fn):
-    if not os.path.exists(fn): # if the file name doesn't exist, don't change the name
-        return fn
-
+# taken holds every name handed out so far (the output directory starts empty), so no file system lookups are needed.
+def add_unique_postfix(fn, taken):
     path, name = os.path.split(fn)
     name, ext = os.path.splitext(name)
 
     make_fn = lambda i: os.path.join(path, '%s(%d)%s' % (name, i, ext))
 
-    for i in range(2, 10000): # finds a number that is not used to put as the suffix
-        uni_fn = make_fn(i)
-        if not os.path.exists(uni_fn):
-            return uni_fn
+    if fn not in taken: # if the file name isn't used, don't change the name
+        taken[fn] = 2
+        return fn
+    i = taken[fn] # next suffix to try for this name
+    while make_fn(i) in taken:
+        i += 1
+    taken[fn] = i + 1
+    taken[make_fn(i)] = 2
+    return make_fn(i)
+
+FICLONE = 0x40049409 # linux/fs.h, clone a whole file (btrfs, xfs, ...)
+
+def link_file(src, dst, mode): # put another copy of an extracted image in a taxon folder
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+            return
+        if mode == 'symlink':
+            os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst) # relative, so the output folder can be moved
+            return
+        if mode == 'reflink':
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return
+    except OSError: # not supported by the file system, fall back to a copy
+        if os.path.lexists(dst):
+            os.remove(dst)
+    shutil.copy2(src, dst)
 
-    return None
 def get_parser(): # get command line options
     parser = argparse.ArgumentParser(description="Tool that was created to help expand the data for the taxon that we do not have many images of by utilizing the data from the images that were already classified.")
     # you should do many taxon at once since a lot of the time is lost unzipping files so it is only slightly less efficient
@@ -85,18 +118,46 @@ def get_parser(): # get command line options
     selectgroup.add_argument("-b", "--best_taxon", action="store_true", help="Extracts the images if the image was classified as a certain taxa, that is one of the taxons that you are trying to find.")
 
     inputgroup = parser.add_mutually_exclusive_group(required=True)
-    inputgroup.add_argument("-d", "--input_drive", type=directory, help="The directory that you want to be pulling csv files from to look for images")
+    inputgroup.add_argument("-d", "--input_drive", type=directory, help="The directory that you want to be pulling csv files (or their .npy copies) from to look for images")
     inputgroup.add_argument("-c", "--input_csv", type=csv_type, help="The csv file that you want to look for taxon images.")
+    inputgroup.add_argument("-db", "--store", type=sqlite_type, help="The results.sqlite of a transect (see store.py) to query instead of scanning csv files. Only the top class of each image is stored, so -p applies to the top probability.")
 
     parser.add_argument("-o", "--output", required=True, type=directory, help="The directory that you want to put the taxon folders of images")
     parser.add_argument("-r", "--raw_tars", required=True, type=directory, help="The directory of all of the tar images that correspond to the csv data")
     parser.add_argument("-m", "--min_images", type=int, default=0, help="The minimum number of images you need to have in a tar.gz in order to unzip it, this defaults to 0")
+    parser.add_argument("-k", "--top_k", type=int, default=0, help="Only keep the k most probable images of each taxon in each csv, this defaults to 0 (keep all)")
+    parser.add_argument("-l", "--link", choices=["copy", "hardlink", "reflink", "symlink"], default="copy", help="How images that match several taxa are put in the other taxon folders, this defaults to copy. reflink and hardlink fall back to a copy where the file system does not support them.")
+    parser.add_argument("-f", "--format", choices=["folders", "shards"], default="folders", help="Write the images into taxon folders, or pack them into size-bounded shards with label manifests that shards.py expands into taxon folders. This defaults to folders.")
+    parser.add_argument("--shard_size", type=scratch.parse_size, default="1G", help="Maximum size of a shard (e.g. 500M, 2G), this defaults to 1G")
+    parser.add_argument("-j", "--processes", type=int, default=os.cpu_count(), help="Number of csv files to search at once, this defaults to the number of cores")
 
     parser.add_argument("-dc", "--different_columns", action="store_true", default=False, help="Checks all of the csvs and tar.gz files. This should be used if the csv files do not follow the same pattern.")
     parser.add_argument("-s", "--strict_subclasses", action="store_true", default=False, help="Doesn't find any substrings, only uses the taxon names that you input exactly")
 
     return parser
 
+def match_tars(csvs, tars_dir): # {csv: tar} from the catalog of the transect, falling back to the file names
+    tars = {archive.strip_extension(tar): os.path.join(tars_dir, tar) for tar in os.listdir(tars_dir) if archive.is_archive(tar)}
+    cataloged = dict()
+    if os.path.isfile(catalog.catalog_path(tars_dir)):
+        cataloged = {results.prefix(result): tar for result, tar in catalog.result_tars(tars_dir).items()}
+
+    file_dict = dict()
+    for csv_file in csvs:
+        name = os.path.basename(results.prefix(csv_file))
+        if results.prefix(os.path.abspath(csv_file)) in cataloged:
+            file_dict[csv_file] = os.path.join(tars_dir, cataloged[results.prefix(os.path.abspath(csv_file))])
+        elif name in tars: # <tar>.csv as written by classification.py
+            file_dict[csv_file] = tars[name]
+        else: # older names containing the tar name
+            matches = [tar for unique_name, tar in tars.items() if unique_name in name]
+            if (len(matches) > 1):
+                print("Error: More than one tar file have been matched with the csv file %s." % csv_file)
+                exit()
+            if (len(matches) == 1):
+                file_dict[csv_file] = matches[0]
+    return file_dict
+
 def validate_args(parser): # verify the command line options that the user plugged in and print them out
     args = parser.parse_args()
     tars_dir = args.raw_tars
@@ -104,38 +165,22 @@ def validate_args(parser): # verify the command line options that the user plugg
     csvs = []
     file_dict = {}
     if(args.input_drive): # several csv files
-        csvs = glob.glob(args.input_drive + "/*.csv")# do something here so that program goes through and gets all of the csv files
+        csvs = results.find(args.input_drive) # the csv of every result, or its .npy when written with results_format = npy
         if(len(csvs) == 0):
-            parser.error("-d, --input_drive Directory does not contain any csv files")
+            parser.error("-d, --input_drive Directory does not contain any csv or npy results")
         print("Input Drive: %s" % (args.input_drive))
         print("Number of Input CSVs: %d" % (len(csvs)))
 
         # create dictionary linking between tar files and csvs
-        file_dict = {}
-        for tar in os.listdir(tars_dir):
-            unique_name = os.path.basename(tar).replace(".tar","")
-            matches = glob.glob(str(args.input_drive) + "/*" + str(unique_name) + "*.csv")
-            if (len(matches) >= 1):
-                csv_filename = matches[0]
-                if (csv_filename not in file_dict):
-                    file_dict[csv_filename] = os.path.join(tars_dir, tar)
-                else:
-                    print("Error: More than one tar file have been matched with a csv file.")
-                    exit()
+        file_dict = match_tars(csvs, tars_dir)
+
+    elif(args.store): # the results store lists the tar of every image
+        print("Results store:", args.store)
 
     else: # a single csv files
         print("Input CSV:", args.input_csv)
-        for tar in os.listdir(tars_dir):
-            unique_name = os.path.basename(tar).replace(".tar","")
-            if (unique_name in os.path.basename(args.input_csv)):
-
-                if (args.input_csv not in file_dict):
-                    file_dict[args.input_csv] = os.path.join(tars_dir, tar)
-                else:
-                    print("Error: More than one tar file have been matched with the given csv file.")
-                    exit()
-
         csvs.append(args.input_csv)
+        file_dict = match_tars(csvs, tars_dir)
 
     for csv_file in csvs:
         if (csv_file not in file_dict):
@@ -161,7 +206,7 @@ def validate_args(parser): # verify the command line options that the user plugg
         probability = args.probability_taxon
         print("\n----- Finding chosen taxon with probabilities above %s -----" % probability)
 
-    return csvs, tars_dir, out_dir, file_dict, min_images, args.best_taxon, args.probability_taxon, args.different_columns, args.strict_subclasses
+    return csvs, tars_dir, out_dir, file_dict, min_images, args.best_taxon, args.probability_taxon, args.different_columns, args.strict_subclasses, args.taxon, args.store, args.top_k, args.processes, args.link, args.format, args.shard_size
 
 def find_all_taxon(csv): # NOTE: this is assuming the csv's collumns are all the same.
     taxon_exist = next(csv)[1:]
@@ -172,7 +217,7 @@ def invalid_taxon(parser, taxon_exist, all_taxon): # see if any of the taxon wer
     args = parser.parse_args()
     numInvalid = 0 # store the number of invalid taxon
     for i, taxon in enumerate(all_taxon):
-        if(taxon not in taxon_exist):
+        if(taxon not in taxon_exist) and (args.strict_subclasses or not any([taxon in t for t in taxon_exist])):
             if(args.different_columns):
                 numInvalid += 1
                 print("\"%s\" was ignored since it isn't a valid substring of a taxon name for this csv file" % (taxon))
@@ -188,83 +233,154 @@ def print_taxon(taxon_locations):
     for i, (taxon, sub_taxon) in enumerate(taxon_locations.values()):
         print("%d. %s" % (i, sub_taxon))
 
-def find_top(csv, taxon_locations):
-    matched_images = dict()
-    for row in csv:
-        top_col = 1
-        for col, prob in enumerate(row):
-            if col < 2: continue # skip the image name row
-            # TODO maybe add quickselect here to get the top k elements
-            if float(prob) > float(row[top_col]):
-                 top_col = col
-        if top_col in taxon_locations: # check if top_col is in the dictionary
-            image = os.path.basename(row[0])
-            matched_images[image] = [taxon_locations[top_col]] # add the image to the matched images dict
-    return matched_images
+def find_taxon_locations(taxon_exist, all_taxon, strict): # {column: (taxon, sub_taxon)} of every class matching a requested taxon
+    taxon_locations = dict()
+    for col, sub_taxon in enumerate(taxon_exist):
+        for taxon in (all_taxon or [sub_taxon]): # no -t means every class
+            if (sub_taxon == taxon) or (not strict and taxon in sub_taxon):
+                taxon_locations[col] = (taxon, sub_taxon)
+                break
+    return taxon_locations
+
+def find_top(probs, taxon_locations): # images whose most probable class is one of taxon_locations
+    cols = np.array(sorted(taxon_locations), dtype = int)
+    top = probs.argmax(axis = 1)
+    rows = np.flatnonzero(np.isin(top, cols))
+    return rows, top[rows][:, None] == cols[None, :]
+
+def find_above_prob(probs, taxon_locations, probability): # images with any of taxon_locations above probability
+    cols = np.array(sorted(taxon_locations), dtype = int)
+    above = probs[:, cols] > probability
+    rows = np.flatnonzero(above.any(axis = 1))
+    return rows, above[rows]
+
+def top_k(probs, rows, hits, cols, k): # keep the k most probable images of each taxon column
+    for j, col in enumerate(cols):
+        selected = np.flatnonzero(hits[:, j])
+        if len(selected) > k:
+            order = np.argpartition(-probs[rows[selected], col], k)
+            hits[selected[order[k:]], j] = False
+    return hits
+
+def select_images(csv_file, all_taxon, best, probability, strict, k = 0):
+    """{image: [sub_taxon]} for one csv (or its .npy copy), evaluating every taxon in one pass over the matrix."""
+    names, taxon_exist, probs = results.load(csv_file)
+    taxon_locations = find_taxon_locations(taxon_exist, all_taxon, strict)
+    if len(taxon_locations) == 0 or len(names) == 0:
+        return dict()
+
+    probs = np.asarray(probs, dtype = np.float32)
+    cols = np.array(sorted(taxon_locations), dtype = int)
+    if best:
+        rows, hits = find_top(probs, taxon_locations)
+    else:
+        rows, hits = find_above_prob(probs, taxon_locations, probability)
+    if k > 0:
+        hits = top_k(probs, rows, hits, cols, k)
 
-def find_above_prob(csv, taxon_locations, probability):
     matched_images = dict()
-    for row in csv:
-        for i in range(len(taxon_locations)):
-            if float(row[i+1]) > probability: # if one is found this tar.gz now needs to be unzipped
-                image = os.path.basename(row[0])
-                if image not in matched_images:
-                     matched_images[image] = [taxon_locations[i]]
-                else:
-                     matched_images[image].append(taxon_locations[i]) # add taxon to hashmap for the image
+    for row, row_hits in zip(rows, hits):
+        if row_hits.any():
+            matched_images[os.path.basename(names[row])] = [taxon_locations[cols[j]][1] for j in np.flatnonzero(row_hits)]
     return matched_images
 
-def untar(tar, out_dir):
-    print("Unzipping %s into %s" % (tar, out_dir))
-    t = tarfile.open(tar, 'r') # set up the file pointer for the tar file
-    t.extractall(out_dir) # all images into the out_dir
-
-def build_structure(path_array, taxon_locations):
-    for i in enumerate(path_array): # shouldn't ever be that many, dependant on your minimum detection probability.
-        dir_structure = "/" + taxon_locations + "/"
-        os.makedirs(out_dir + dir_structure, exist_ok = True) # TODO: maybe move this to another place so that it is not done in a loop
-        if(len(path_array) > 1): # then we will need to copy the image to multiple directories
-            if(i < len(path_array) - 1):
-                shutil.copy2(img, out_dir + dir_structure)
-            else: # move the last one instead of copying it
-                shutil.move(img, out_dir + dir_structure)
-        else:  # move to one directory
-            image_unique = add_unique_postfix(out_dir + dir_structure + os.path.basename(img)) # make sure there is a unique image name
-            shutil.move(img, image_unique)
+def select_csv(job): # pool entry point
+    csv_file, all_taxon, best, probability, strict, k = job
+    return csv_file, select_images(csv_file, all_taxon, best, probability, strict, k)
+
+def find_in_store(store_file, all_taxon, probability, strict):
+    """{tar: {image: [class]}} of the images whose top class matches, from a results store."""
+    matched = dict()
+    for image, tar, frame, taxon, prob in store.query(store_file, all_taxon, probability or 0, strict):
+        matched.setdefault(tar, dict())[image] = [taxon]
+    return matched
+
+def make_taxon_dirs(matched, out_dir, made): # every taxon folder is made once, before any extraction
+    for taxon in set([taxon for matched_images in matched for taxa in matched_images.values() for taxon in taxa]) - made:
+        os.makedirs(os.path.join(out_dir, taxon), exist_ok = True)
+        made.add(taxon)
+
+def plan_outputs(matched_images, out_dir, taken): # {image: [output file per taxon]}, named before any worker writes
+    return {image: [add_unique_postfix(os.path.join(out_dir, taxon, image), taken) for taxon in taxa] for image, taxa in matched_images.items()}
+
+def extract_matched(job): # write only the matched members of a tar straight into their taxon folders
+    tar_file, outputs, link = job
+    written = archive.extract_matching(tar_file, lambda name: os.path.basename(name) in outputs, lambda name: outputs[os.path.basename(name)][0])
+    for name, image_path in written.items():
+        for other in outputs[os.path.basename(name)][1:]: # the other taxa the image matched
+            link_file(image_path, other, link)
+    return tar_file, len(written)
+
+def read_matched(job): # the data of the matched members of a tar, packed into shards by the main process
+    tar_file, outputs = job
+    return tar_file, [(data, outputs[os.path.basename(name)]) for name, data in archive.read_matching(tar_file, lambda name: os.path.basename(name) in outputs)]
+
+def submit_extraction(pool, tar_file, matched_images, out_dir, taken, link, shard_writer):
+    if shard_writer is None:
+        return pool.apply_async(extract_matched, ((tar_file, plan_outputs(matched_images, out_dir, taken), link),))
+    files = plan_outputs(matched_images, '', taken) # relative to the folder the shards are expanded into
+    return pool.apply_async(read_matched, ((tar_file, {image: list(zip(matched_images[image], files[image])) for image in matched_images}),))
+
+def finish_extraction(extraction, shard_writer):
+    if shard_writer is None:
+        tar_file, n_images = extraction.get()
+    else:
+        tar_file, images = extraction.get()
+        for data, files in images:
+            shard_writer.add(data, files)
+        n_images = len(images)
+    print(f"Extracted {n_images} images from {tar_file}")
 
 if __name__ == "__main__":
     """Main entry to pull_all.py"""
     
     v_string = "V2023.09.05"
     parser = get_parser() # get command line arguments
-    csvs, tars_dir, out_dir, file_dict, min_images, best, probability, different, strict = validate_args(parser) # error check arguments further
+    csvs, tars_dir, out_dir, file_dict, min_images, best, probability, different, strict, all_taxon, store_file, k, processes, link, output_format, shard_size = validate_args(parser) # error check arguments further
     print(v_string)
-    print(file_dict)
-
-    f = open(csvs[0])
-    _csv = csv.reader(f)
-    e_taxon = find_all_taxon(_csv) # read the taxon from the first csv file
-    f.close()
-
-    # this is the main processing part of the program
-    for csv_file in csvs: # loop through all of the csv files
-        print("\nFinding images from", csv_file)
-
-        f = open(csv_file)
-        _csv = csv.reader(f)
-        name_line = next(_csv) # remove nameline
-        tar_file = file_dict[csv_file]
-        untar(tar_file, out_dir)
-
-        for taxon_locations in e_taxon:
-            matched_images = dict()
-            matched_images = find_above_prob(_csv, taxon_locations, probability)
-
-            print(f"Found {len(matched_images)} images in {csv_file} for {taxon_locations}")
-            print("Building file structure")
-            for img in glob.glob(out_dir + f'/{taxon_locations}*.jpg'): # loop through all the images in the untared directory
-                path_array = matched_images[os.path.basename(img)]
-                build_structure(path_array, taxon_locations) # move all of the images to the correct sub-directory
-        f.close()
+
+    shard_writer = shards.ShardWriter(out_dir, shard_size) if output_format == 'shards' else None
+    made, taken = set(), dict() # taxon folders and image names so far, only the main process names files
+
+    if store_file: # select from the store, then only open the tars that have matches
+        matched = find_in_store(store_file, all_taxon, probability, strict)
+        print(f"Found {sum([len(m) for m in matched.values()])} images in {len(matched)} tars")
+        with Pool(max(1, processes)) as pool:
+            extractions = []
+            for tar, matched_images in matched.items():
+                if len(matched_images) < max(1, min_images):
+                    continue
+                if shard_writer is None:
+                    make_taxon_dirs([matched_images], out_dir, made)
+                extractions.append(submit_extraction(pool, os.path.join(tars_dir, tar), matched_images, out_dir, taken, link, shard_writer))
+            for extraction in extractions:
+                finish_extraction(extraction, shard_writer)
+        if shard_writer is not None:
+            shard_writer.close()
+        print("----- Done -----")
+        exit()
+
+    e_taxon = results.load(csvs[0])[1] # read the taxon from the first csv file
+    if all_taxon:
+        if invalid_taxon(parser, e_taxon, all_taxon):
+            exit()
+        print_taxon(find_taxon_locations(e_taxon, all_taxon, strict))
+
+    # this is the main processing part of the program: every csv is searched once for all taxa
+    # tars are extracted by the same pool as soon as their csv has been searched
+    jobs = [(csv_file, all_taxon, best, probability, strict, k) for csv_file in csvs]
+    with Pool(max(1, processes)) as pool:
+        extractions = []
+        for csv_file, matched_images in pool.imap_unordered(select_csv, jobs):
+            print(f"Found {len(matched_images)} images in {csv_file}")
+            if len(matched_images) < max(1, min_images): # skipped without opening the tar
+                continue
+            if shard_writer is None:
+                make_taxon_dirs([matched_images], out_dir, made)
+            extractions.append(submit_extraction(pool, file_dict[csv_file], matched_images, out_dir, taken, link, shard_writer))
+        for extraction in extractions:
+            finish_extraction(extraction, shard_writer)
+    if shard_writer is not None:
+        shard_writer.close()
 
     print("----- Done -----")
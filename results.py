@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Compact classification results for UAF-Plankline
+    SCNN writes one wide csv per tar: the image path followed by one
+    probability per class, as text. Reading a transect back means parsing
+    every cell with float(). Here the same table is kept as
+
+        <id>.npy    probability matrix (crops x classes), float16 or float32
+        <id>.json   {"classes": [...], "names": [...], "dtype": ...}
+
+    The .npy file is loaded memory mapped, so selecting crops or binning a
+    whole transect only touches the columns that are used. float16 keeps
+    about three significant digits, which is plenty for probabilities.
+
+Usage:
+    import results
+    names, classes, probs = results.load('<classification dir>/<id>.npy')
+    ./results.py <csv> [<csv> ...] [-t float32] [--remove]   (convert existing csvs)
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import csv
+import glob
+import json
+import argparse
+import numpy as np
+
+DTYPES = ['float16', 'float32']
+
+
+def prefix(path):
+    """Path without its .csv/.npy/.json extension."""
+    root, ext = os.path.splitext(path)
+    return root if ext in ['.csv', '.npy', '.json'] else path
+
+
+def read_csv(csv_path, dtype = 'float32'):
+    """(names, classes, probs) from an SCNN csv."""
+    with open(csv_path, newline = '') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        names = []
+        rows = []
+        for row in reader:
+            if len(row) == 0:
+                continue
+            names.append(row[0])
+            rows.append(row[1:])
+    probs = np.array(rows, dtype = dtype).reshape(len(rows), len(header) - 1)
+    return names, header[1:], probs
+
+
+def write(path, names, classes, probs, dtype = 'float16'):
+    """Write <path>.npy and <path>.json; both appear only once complete. Returns the .npy path."""
+    path = prefix(path)
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown results dtype {dtype}, use one of {', '.join(DTYPES)}")
+
+    with open(path + '.npy.part', 'wb') as f:
+        np.save(f, np.asarray(probs, dtype = dtype))
+    with open(path + '.json.part', 'w') as f:
+        json.dump({'classes': list(classes), 'names': list(names), 'dtype': dtype}, f)
+    os.replace(path + '.json.part', path + '.json')
+    os.replace(path + '.npy.part', path + '.npy')
+    return path + '.npy'
+
+
+def convert(csv_path, dtype = 'float16', remove = False):
+    """Write the compact copy of an SCNN csv next to it. Returns the .npy path."""
+    names, classes, probs = read_csv(csv_path)
+    npy_path = write(csv_path, names, classes, probs, dtype)
+    if remove:
+        os.remove(csv_path)
+    return npy_path
+
+
+def is_stale(path):
+    """True if the compact copy of path is older than its csv."""
+    path = prefix(path)
+    return os.path.isfile(path + '.csv') and os.path.getmtime(path + '.csv') > os.path.getmtime(path + '.npy')
+
+
+def find(directory):
+    """One path per result in directory: its csv, or its .npy if there is no csv."""
+    csvs = glob.glob(glob.escape(directory) + '/*.csv')
+    npys = [npy for npy in glob.glob(glob.escape(directory) + '/*.npy') if not os.path.isfile(prefix(npy) + '.csv')]
+    return sorted(csvs + npys)
+
+
+def load(path, mmap = True):
+    """(names, classes, probs) of a result; probs is memory mapped unless mmap is False.
+
+    path may be the .npy, the .json or the .csv it was converted from. Falls back
+    to parsing the csv if there is no compact copy, or if the csv was written
+    after it (e.g. rerun with results_format = csv).
+    """
+    path = prefix(path)
+    if not os.path.isfile(path + '.npy') or is_stale(path):
+        return read_csv(path + '.csv')
+
+    with open(path + '.json') as f:
+        meta = json.load(f)
+    probs = np.load(path + '.npy', mmap_mode = 'r' if mmap else None)
+    return meta['names'], meta['classes'], probs
+
+
+if __name__ == "__main__":
+    """Convert existing SCNN csv files."""
+
+    parser = argparse.ArgumentParser(description="Converts SCNN csv files to compact .npy/.json results.")
+    parser.add_argument("csvs", nargs = '+', help = "SCNN csv files.")
+    parser.add_argument("-t", "--dtype", default = 'float16', choices = DTYPES, help = "Precision of the stored probabilities.")
+    parser.add_argument("--remove", action = "store_true", help = "Delete each csv once converted.")
+    args = parser.parse_args()
+
+    for csv_path in args.csvs:
+        npy_path = convert(csv_path, args.dtype, args.remove)
+        print(f"{csv_path} -> {npy_path} ({os.path.getsize(npy_path)/10**6:.1f} MB)")
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Job cost model for UAF-Plankline
+    Orders segmentation and classification work longest-first so that a large
+    AVI or tar picked up last does not leave every other worker idle. A job's
+    cost is its size in units (frames of an AVI, crops in a tar) times a rate
+    in seconds per unit fitted from the timings already written to earlier run
+    logs (timer_seg, timer_scnn). Jobs that were timed before use their own
+    logged time. The same costs give a predicted run time for the worker count,
+    and job footprints give the peak scratch space needed.
+
+Usage:
+    import scheduler
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import re
+import datetime
+import heapq
+import statistics
+
+# fileFormatter in logging.ini: asctime (two fields), process, name, levelname, message
+LOG_LINE = re.compile(r'^\S+ \S+\s+(\d+)\s+\S+\s+\S+\s+(.*)$')
+
+
+def logged_timings(log_files, name_prefix, timer_prefix):
+    """Seconds per input name from previous run logs.
+
+    Workers log the input they start on (e.g. 'avi_file: x.avi') and later the
+    timer ('Segmentation executable took 12.3 s.'). Log lines from different
+    workers are interleaved, so the two are paired by process id.
+    """
+    timings = {}
+    for log_file in log_files:
+        current = {} # pid -> input being processed
+        with open(log_file, errors = 'replace') as f:
+            for line in f:
+                m = LOG_LINE.match(line.rstrip('\n'))
+                if m is None:
+                    continue
+                pid, message = m.groups()
+                if message.startswith(name_prefix):
+                    current[pid] = message[len(name_prefix):].strip()
+                elif message.startswith(timer_prefix) and pid in current:
+                    try:
+                        timings[current.pop(pid)] = float(message[len(timer_prefix):].split()[0])
+                    except ValueError:
+                        continue
+    return timings
+
+
+def estimate_costs(jobs, units, key, timings, reference = ()):
+    """Estimated seconds for every job.
+
+    units(job) is the size of the job and key(job) its name in timings. The
+    rate in seconds per unit is the median over jobs and reference inputs that
+    have a logged time. Without any history the costs are the units
+    themselves, which still gives a longest-first order.
+    Returns (costs, rate) where rate is None if there was no history.
+    """
+    sizes = {job: units(job) for job in jobs}
+    for ref in reference:
+        if key(ref) in timings and ref not in sizes:
+            sizes[ref] = units(ref)
+
+    rates = [timings[key(job)] / size for job, size in sizes.items() if key(job) in timings and size > 0]
+    rate = statistics.median(rates) if len(rates) > 0 else None
+
+    costs = {}
+    for job in jobs:
+        if key(job) in timings:
+            costs[job] = timings[key(job)]
+        elif rate is not None:
+            costs[job] = sizes[job] * rate
+        else:
+            costs[job] = sizes[job]
+    return costs, rate
+
+
+def longest_first(jobs, costs):
+    """Jobs sorted by decreasing cost."""
+    return sorted(jobs, key = lambda job: costs[job], reverse = True)
+
+
+def grouped_longest_first(jobs, costs, group):
+    """Jobs of the same group(job) kept together, groups by decreasing total cost, longest first within a group."""
+    totals = {}
+    for job in jobs:
+        totals[group(job)] = totals.get(group(job), 0) + costs[job]
+    return sorted(jobs, key = lambda job: (totals[group(job)], group(job), costs[job]), reverse = True)
+
+
+def predict_makespan(costs, workers):
+    """Wall clock seconds for dispatching the costs longest-first to workers."""
+    finish = [0.0] * max(1, workers)
+    for cost in sorted(costs, reverse = True):
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
+
+
+def peak_scratch(footprints, workers):
+    """Upper bound on scratch in use at once: the largest footprints running together."""
+    return sum(sorted(footprints, reverse = True)[:max(1, workers)])
+
+
+def output_ratio(entries, default = 1.0):
+    """Median output size / input size over the entries of a manifest."""
+    ratios = [e['output_size'] / e['signature']['size'] for e in entries.values() if e['signature']['size'] > 0]
+    return statistics.median(ratios) if len(ratios) > 0 else default
+
+
+def summary(costs, rate, workers, footprints, unit):
+    """Printable plan for the run."""
+    lines = []
+    if rate is None:
+        lines.append(f"No timing history found, ordering {len(costs)} jobs by {unit}.")
+    else:
+        eta = predict_makespan(list(costs.values()), workers)
+        lines.append(f"Predicted run time: {datetime.timedelta(seconds = round(eta))} for {len(costs)} jobs on {workers} workers ({rate:.4f} s per {unit[:-1]}).")
+    lines.append(f"Predicted peak scratch: {peak_scratch(footprints, workers)/10**9:.1f} GB.")
+    return '\n'.join(lines)
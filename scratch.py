@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""Scratch space manager for UAF-Plankline
+    Segmentation crops and classification extracts are written to scratch
+    before they end up in a tar or a csv. Each job reserves its estimated
+    footprint before writing anything, and gets a directory in the first
+    scratch location with room for it: the stage's fast_scratch (ideally RAM
+    backed, e.g. /dev/shm) and then the [general] scratch_spill locations on
+    disk. When nothing fits the job waits until another job releases its
+    space. Jobs release their space, and delete their directory, as soon as
+    their output is safely written.
+
+    Reservations are kept in a ledger file in each location, shared by all
+    processes (segmentation, classification and plankline runs at once)
+    through a file lock. Reservations of processes that no longer exist are
+    dropped, so a crashed worker does not hold its space forever.
+
+Usage:
+    import scratch
+    space = scratch.from_config(config, 'segmentation', 'segment-<session>', permis)
+    path = space.reserve(name, nbytes)
+    ...
+    space.release(name)
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import logging
+from time import time, sleep
+from contextlib import contextmanager
+
+LEDGER_NAME = '.scratch_ledger.json'
+LOCK_NAME = '.scratch_lock'
+UNITS = {'K': 10**3, 'M': 10**6, 'G': 10**9, 'T': 10**12}
+
+
+def parse_size(text):
+    """Bytes from '500M', '20G', '1.5T' or a plain number."""
+    text = text.strip().upper().rstrip('B')
+    if text == '':
+        return 0
+    if text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(float(text))
+
+
+def roots(config, section):
+    """Scratch locations of a stage in order of preference: its fast_scratch, then [general] scratch_spill."""
+    spill = config['general'].get('scratch_spill', fallback = '')
+    return [config[section]['fast_scratch']] + [p.strip() for p in spill.split(',') if p.strip() != '']
+
+
+def from_config(config, section, subdir, permis = 0o777):
+    return Scratch(roots(config, section), subdir,
+        quota = parse_size(config['general'].get('scratch_quota', fallback = '0')),
+        headroom = parse_size(config['general'].get('scratch_headroom', fallback = '1G')),
+        permis = permis)
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def locked(root):
+    """Exclusive lock on the ledger of root."""
+    os.makedirs(root, exist_ok = True)
+    fd = os.open(os.path.join(root, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def read_ledger(root):
+    """{key: reservation} of root, including stale ones. Call with the lock held."""
+    path = os.path.join(root, LEDGER_NAME)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return {}
+
+
+def load_ledger(root):
+    """{key: reservation} of root without reservations of dead processes. Call with the lock held."""
+    return {key: entry for key, entry in read_ledger(root).items() if alive(entry['pid'])}
+
+
+def save_ledger(root, ledger):
+    path = os.path.join(root, LEDGER_NAME)
+    with open(path + '.part', 'w') as f:
+        json.dump(ledger, f)
+    os.replace(path + '.part', path)
+
+
+class Scratch:
+    """Reservations of one stage (subdir) over a list of scratch locations."""
+
+    def __init__(self, roots, subdir, quota = 0, headroom = 10**9, wait = 5, permis = 0o777):
+        self.roots = roots          # preferred (RAM) first
+        self.subdir = subdir        # e.g. segment-<session>, keeps runs apart
+        self.quota = quota          # bytes that may be reserved per location, 0 for free space only
+        self.headroom = headroom    # bytes always left free
+        self.wait = wait
+        self.permis = permis
+
+    def path(self, root, name):
+        return os.path.join(root, self.subdir, name)
+
+    def _fits(self, root, ledger, nbytes):
+        reserved = sum([entry['bytes'] for entry in ledger.values()])
+        if self.quota > 0 and reserved + nbytes > self.quota:
+            return False
+        # Conservative: other jobs may still write all of what they reserved.
+        return shutil.disk_usage(root).free - self.headroom - reserved >= nbytes
+
+    def reserve(self, name, nbytes, logger = logging.getLogger('sLogger')):
+        """Reserve nbytes for name and return its (new, empty) directory, waiting for space if needed."""
+        key = f"{self.subdir}/{name}"
+        timer_wait = time()
+        waiting = False
+        while True:
+            for root in self.roots:
+                with locked(root):
+                    ledger = load_ledger(root)
+                    if self._fits(root, ledger, nbytes):
+                        return self._grant(root, ledger, key, name, nbytes, logger, timer_wait)
+
+            if not self._anything_reserved():
+                # Nothing will be released, so waiting would not help: use the location with the most room.
+                root = max(self.roots, key = lambda r: shutil.disk_usage(r).free)
+                logger.warning(f"Scratch reservation of {nbytes/10**9:.2f} GB for {name} does not fit any location, using {root}.")
+                with locked(root):
+                    return self._grant(root, load_ledger(root), key, name, nbytes, logger, timer_wait)
+
+            if not waiting:
+                logger.info(f"Waiting for {nbytes/10**9:.2f} GB of scratch space for {name}.")
+                waiting = True
+            sleep(self.wait)
+
+    def _grant(self, root, ledger, key, name, nbytes, logger, timer_wait):
+        ledger[key] = {'bytes': nbytes, 'pid': os.getpid(), 'root': root, 'time': int(time())}
+        save_ledger(root, ledger)
+        path = self.path(root, name)
+        os.makedirs(path, self.permis, exist_ok = True)
+        logger.debug(f"Reserved {nbytes/10**9:.2f} GB of scratch in {root} for {name} after {time() - timer_wait:.3f} s.")
+        return path
+
+    def _anything_reserved(self):
+        for root in self.roots:
+            with locked(root):
+                if len(load_ledger(root)) > 0:
+                    return True
+        return False
+
+    def release(self, name):
+        """Delete the directory of name and free its reservation."""
+        key = f"{self.subdir}/{name}"
+        for root in self.roots:
+            with locked(root):
+                ledger = load_ledger(root)
+                if key in ledger:
+                    del ledger[key]
+                    save_ledger(root, ledger)
+            shutil.rmtree(self.path(root, name), ignore_errors = True)
+
+    @contextmanager
+    def job(self, name, nbytes, logger = logging.getLogger('sLogger')):
+        """reserve for the duration of a with block; released however the block exits."""
+        path = self.reserve(name, nbytes, logger)
+        try:
+            yield path
+        finally:
+            self.release(name)
+
+    def remove_all(self):
+        """Delete the directories and reservations of this stage in every location."""
+        for root in self.roots:
+            with locked(root):
+                ledger = load_ledger(root)
+                save_ledger(root, {key: entry for key, entry in ledger.items() if not key.startswith(self.subdir + '/')})
+            shutil.rmtree(os.path.join(root, self.subdir), ignore_errors = True)
+
+
+def usage(root):
+    """(live reservations, stale reservations) in the ledger of root."""
+    if not os.path.isfile(os.path.join(root, LEDGER_NAME)):
+        return {}, {}
+    with locked(root):
+        ledger = read_ledger(root)
+    live = {key: entry for key, entry in ledger.items() if alive(entry['pid'])}
+    stale = {key: entry for key, entry in ledger.items() if key not in live}
+    return live, stale
+
+
+def prune(root):
+    """Drop stale reservations from the ledger of root and delete their directories. Returns their keys."""
+    if not os.path.isfile(os.path.join(root, LEDGER_NAME)):
+        return []
+    with locked(root):
+        ledger = read_ledger(root)
+        stale = [key for key, entry in ledger.items() if not alive(entry['pid'])]
+        save_ledger(root, {key: entry for key, entry in ledger.items() if key not in stale})
+    for key in stale:
+        shutil.rmtree(os.path.join(root, key), ignore_errors = True)
+    return stale
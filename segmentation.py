@@ -29,42 +29,547 @@ License:
 """
 
 import os
+import re
 import sys
+import glob
 import shutil
 import argparse
+import itertools
+import csv
 import logging # TBK: logging module
 import logging.config # TBK
 import configparser # TBK: To read config file
 import tqdm # TBK
-from time import time
+import tarfile
+import subprocess
+from time import time, sleep
 import psutil
 
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import datetime
 
+import archive
+import catalog
+import manifest
+import monitor
+import scheduler
+import scratch
 
-def seg_ff(avi, seg_output, SNR, segment_path):
-    """Formats and calls the segmentation executable"""
+# [segmentation] settings that change the crops written for an AVI.
+SEGMENT_SETTINGS = ['segment', 'signal_to_noise', 'overlap', 'delta', 'max_area', 'min_area', 'full_output']
+
+# Settings that can be given as comma separated lists in [benchmark].
+BENCHMARK_SETTINGS = ['signal_to_noise', 'overlap', 'delta', 'max_area', 'min_area', 'full_output']
+
+# Concurrent ffprobe calls when counting the frames of many AVIs.
+PROBE_THREADS = 8
+
+frame_counts = {} # path -> frames, so sharding and planning probe each AVI once
+
+
+def seg_ff(avi, seg_output, SNR, segment_path, wait = True, settings = None):
+    """Formats and calls the segmentation executable
+
+    When wait is False the executable is started in the background and the
+    Popen handle is returned so the caller can archive crops while it runs.
+    settings overrides the [segmentation] values (used by the benchmark).
+    """
+    if settings is None:
+        settings = config['segmentation']
     snr = str(SNR)
-    epsilon = config['segmentation']['overlap']
-    delta = config['segmentation']['delta']
-    max_area = config['segmentation']['max_area']
-    min_area = config['segmentation']['min_area']
+    epsilon = settings['overlap']
+    delta = settings['delta']
+    max_area = settings['max_area']
+    min_area = settings['min_area']
 
     segment_log = segment_dir + '/segment_' + session_id + '.log'
-    full_output = config['segmentation']['full_output']
+    full_output = settings['full_output']
 
     seg = f'nohup \"{segment_path}\" -i \"{avi}\" -o \"{seg_output}\" -s {snr} -e {epsilon} -M {max_area} -m {min_area} -d {delta} {full_output} >> \"{segment_log}\" 2>&1'
     logger.info("Segmentation call: " + seg)
 
     os.chmod(seg_output, permis)
 
+    if not wait:
+        return subprocess.Popen(seg, shell = True)
+
     timer_seg = time()
     os.system(seg)
     timer_seg = time() - timer_seg
     logger.debug(f"Segmentation finished in {timer_seg:.3f} s.")
 
 
+def is_crop(filename):
+    return 'crop' in filename and filename.endswith('.png')
+
+
+def stream_tar(proc, seg_output, tar_name, codec, rename = None, index_file = None):
+    """Append finished crops in seg_output to tar_name while proc is running.
+
+    Only crop images are streamed, each once it has not been modified for
+    stream_interval seconds; segment keeps appending to its other outputs
+    (stats, measurements) until it exits, so those and anything left over are
+    added afterwards. Each file is removed from scratch as soon as it is in
+    the archive so only the crops still being written take up space.
+    rename, if given, maps each relative path to its name in the archive.
+    The member index is written to index_file if given.
+    """
+    n_files = 0
+    with archive.Writer(tar_name, codec, archive_level, archive_threads, index_file) as tar:
+        while True:
+            running = proc.poll() is None
+            now = time()
+            for dirpath, dirnames, filenames in os.walk(seg_output):
+                dirnames.sort()
+                for f in sorted(filenames):
+                    path = os.path.join(dirpath, f)
+                    if running and not (is_crop(f) and now - os.path.getmtime(path) >= stream_interval):
+                        continue
+                    name = os.path.relpath(path, seg_output)
+                    if rename is not None:
+                        name = rename(name)
+                    tar.add(path, arcname = './' + name)
+                    os.remove(path)
+                    n_files += 1
+
+            if not running:
+                break
+            sleep(stream_interval)
+
+    return n_files
+
+
+def tar_path(avi):
+    """Path of the tar that local_main writes for an avi."""
+    avi_date_code = os.path.splitext(os.path.basename(avi))[0] # remove .avi
+    return segment_dir + "/" + avi_date_code + archive.extension(archive_codec)
+
+
+def remove_superseded(avi):
+    """Delete the tar (and index) an earlier run wrote for avi with another archive_codec, so only the new one is classified."""
+    avi_date_code = os.path.splitext(os.path.basename(avi))[0]
+    for ext in archive.READ_EXTENSIONS:
+        old = segment_dir + "/" + avi_date_code + ext
+        if old != tar_path(avi) and os.path.isfile(old):
+            logger.info(f"Removing {old}, superseded by {tar_path(avi)}.")
+            os.remove(old)
+            if os.path.isfile(archive.index_path(old)):
+                os.remove(archive.index_path(old))
+
+
+def pending(avis):
+    """The avis that do not have a complete, up to date tar in segment_dir.
+
+    A tar written with another archive_codec (another extension) is not up to date either.
+    """
+    entries = manifest.load(segment_dir)
+    return [avi for avi in avis if not manifest.is_complete(entries, avi, manifest.signature(avi, settings_hash))
+        or os.path.basename(entries[os.path.basename(avi)]['output']) != os.path.basename(tar_path(avi))]
+
+
+def count_frames(avi):
+    """Number of video frames in avi according to ffprobe, remembered for the rest of the run.
+
+    None if ffprobe cannot read avi (e.g. an empty or truncated file).
+    """
+    if avi in frame_counts:
+        return frame_counts[avi]
+    try:
+        cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=nb_frames', '-of', 'csv=p=0', avi]
+        frames = subprocess.check_output(cmd).decode('utf-8').strip()
+        if not frames.isdigit(): # not stored in every container, so count the packets instead
+            cmd = [ffprobe, '-v', 'error', '-select_streams', 'v:0', '-count_packets', '-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', avi]
+            frames = subprocess.check_output(cmd).decode('utf-8').strip()
+        frame_counts[avi] = int(frames)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        logger.warning(f"Could not count the frames of {avi}: {e}")
+        frame_counts[avi] = None
+    return frame_counts[avi]
+
+
+def count_all_frames(avis):
+    """count_frames for every avi not counted yet, PROBE_THREADS at a time (ffprobe -count_packets reads the whole file)."""
+    todo = sorted(set([avi for avi in avis if avi not in frame_counts]))
+    if len(todo) > 1:
+        with ThreadPool(min(PROBE_THREADS, len(todo))) as pool:
+            pool.map(count_frames, todo)
+
+
+def shard_avi(avi, n_frames):
+    """Cut avi into shard_frames long pieces on scratch with ffmpeg.
+
+    The pieces go to a scratch reservation the size of the AVI (waiting for
+    room like any job), which merge_shards releases once the AVI is merged.
+    The video stream is copied, not re-encoded. Frame offsets are taken from
+    the shards actually written, so a cut that lands on a later keyframe only
+    shifts the boundary and never the numbering.
+    Returns a list of (shard path, first frame) tuples.
+    """
+    avi_date_code = os.path.splitext(os.path.basename(avi))[0]
+    shard_dir = scratch_space.reserve(avi_date_code + "_shards", os.path.getsize(avi), logger)
+
+    pattern = f"{shard_dir}/{avi_date_code}-shard%03d.avi"
+    cuts = ','.join([str(f) for f in range(shard_frames, n_frames, shard_frames)])
+    cmd = [ffmpeg, '-v', 'error', '-y', '-i', avi, '-map', '0:v:0', '-c', 'copy', '-f', 'segment', '-segment_frames', cuts, '-reset_timestamps', '1', pattern]
+    logger.debug('Sharding call: ' + ' '.join(cmd))
+    subprocess.run(cmd, check = True)
+
+    shards = []
+    offset = 0
+    for shard in sorted(glob.glob(glob.escape(f"{shard_dir}/{avi_date_code}-shard") + '[0-9][0-9][0-9].avi')):
+        shards.append((shard, offset))
+        n = count_frames(shard)
+        if n is None:
+            raise RuntimeError(f"Could not count the frames of {shard}, the crops after it cannot be numbered.")
+        offset += n
+    return shards
+
+
+def shard_jobs(avis):
+    """Expand avis into segmentation jobs, replacing AVIs longer than shard_frames by planned shards.
+
+    Whole AVIs stay as a path; a planned shard is (avi, index, n_shards, n_frames of the AVI).
+    Nothing is cut yet, see cut_shards.
+    """
+    jobs = []
+    count_all_frames(avis)
+    for avi in avis:
+        n_frames = count_frames(avi)
+        if n_frames is None or n_frames <= shard_frames: # unreadable AVIs are left to segment as a whole
+            jobs.append(avi)
+            continue
+
+        # Leftovers from an interrupted run would be merged with the new shards.
+        for f in glob.glob(glob.escape(tar_path(avi)) + '.shard*') + glob.glob(glob.escape(tar_path(avi)) + '.merge'):
+            os.remove(f)
+
+        n_shards = -(-n_frames // shard_frames)
+        jobs += [(avi, i, n_shards, n_frames) for i in range(n_shards)]
+    return jobs
+
+
+def cut_shards(jobs):
+    """Yield the jobs for the pool, cutting an AVI into shards when its first planned shard comes up.
+
+    The pool's task thread consumes this while the workers run, so AVIs are cut
+    one at a time alongside segmentation rather than all up front, and only as
+    far ahead as their scratch reservations (see shard_avi) allow.
+    A shard job is (avi, shard, index, n_shards, first frame); a planned shard
+    the cut did not produce gets shard None. The shards of an AVI that could
+    not be cut are dropped, so the pool may see fewer jobs than planned.
+    """
+    cut = {}
+    for job in jobs:
+        if not isinstance(job, tuple):
+            yield job
+            continue
+
+        avi, index, n_planned, n_frames = job
+        if avi not in cut:
+            timer_shard = time()
+            try:
+                cut[avi] = shard_avi(avi, n_frames)
+            except Exception as e: # the other AVIs still run; this one is left out
+                logger.error(f"Splitting {os.path.basename(avi)} into shards failed: {e}")
+                scratch_space.release(os.path.splitext(os.path.basename(avi))[0] + "_shards")
+                cut[avi] = None
+                continue
+            logger.info(f"Split {os.path.basename(avi)} ({n_frames} frames) into {len(cut[avi])} shards in {time() - timer_shard:.3f} s.")
+        shards = cut[avi]
+        if shards is None:
+            continue
+        shard, offset = shards[index] if index < len(shards) else (None, 0)
+        yield (avi, shard, index, len(shards), offset)
+
+
+def rename_shard_member(name, shard_code, avi_date_code, offset):
+    """Map a crop path written for a shard back to the original AVI.
+
+    The segment executable names its output after the input file followed by
+    the frame number, so '<shard>_<frame>' becomes '<avi>_<frame + offset>'
+    (keeping the zero padding) and any other '<shard>' becomes '<avi>'.
+    """
+    def renumber(m):
+        return f"{avi_date_code}{m.group(1)}{int(m.group(2)) + offset:0{len(m.group(2))}d}"
+
+    name = re.sub(re.escape(shard_code) + r'([_-])(\d+)', renumber, name)
+    return name.replace(shard_code, avi_date_code)
+
+
+def merge_shards(avi, n_shards):
+    """Combine the shard tars of avi into its final tar once all of them are written.
+
+    Called by every shard job; only the one that sees all shards and wins the
+    lock file does the merge. If any shard failed (see local_shard) the AVI is
+    not merged and its pieces are dropped. Returns the tar path if this call merged it.
+    """
+    tar_name = tar_path(avi)
+    parts = sorted(glob.glob(glob.escape(tar_name) + '.shard[0-9][0-9][0-9]'))
+    failed = glob.glob(glob.escape(tar_name) + '.shard[0-9][0-9][0-9].failed')
+    if len(parts) + len(failed) < n_shards:
+        return None
+
+    try:
+        os.close(os.open(tar_name + '.merge', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return None
+
+    if len(failed) > 0:
+        logger.error(f"{len(failed)} of {n_shards} shards of {os.path.basename(avi)} failed, not merging {tar_name}.")
+        for part in parts + failed:
+            os.remove(part)
+        os.remove(tar_name + '.merge')
+        scratch_space.release(os.path.splitext(os.path.basename(avi))[0] + "_shards")
+        return None
+
+    logger.info(f"Merging {n_shards} shards into {tar_name}.")
+    timer_merge = time()
+    with archive.Writer(tar_name + '.part', archive_codec, archive_level, archive_threads, archive.index_path(tar_name)) as tar:
+        for part in parts:
+            with tarfile.open(part) as t:
+                for member in t:
+                    tar.addfile(member, t.extractfile(member))
+
+    os.replace(tar_name + '.part', tar_name)
+    os.chmod(tar_name, permis)
+    os.chmod(archive.index_path(tar_name), permis)
+    remove_superseded(avi)
+    catalog.add_tar(segment_dir, tar_name, avi)
+    manifest.record(segment_dir, avi, manifest.signature(avi, settings_hash), tar_name)
+    for part in parts:
+        os.remove(part)
+    os.remove(tar_name + '.merge')
+    scratch_space.release(os.path.splitext(os.path.basename(avi))[0] + "_shards")
+    logger.debug(f"Merging shards took {time() - timer_merge:.3f} s.")
+    return tar_name
+
+
+def local_shard(job):
+    """Segment one shard of an AVI into its own uncompressed tar, renumbering the crops.
+
+    Returns the final tar path if this was the last shard of the AVI, otherwise None.
+    """
+    avi, shard, index, n_shards, offset = job
+    if shard is None: # the cut made fewer shards than planned
+        return merge_shards(avi, n_shards)
+    avi_date_code = os.path.splitext(os.path.basename(avi))[0]
+    shard_code = os.path.splitext(os.path.basename(shard))[0]
+    part = f"{tar_path(avi)}.shard{index:03d}"
+
+    logger.info(f'Starting shard {index + 1} of {n_shards} for {avi_date_code} (first frame {offset}).')
+    seg_output = scratch_space.reserve(shard_code + "_s", os.path.getsize(shard) * scratch_ratio, logger)
+
+    timer_seg = time()
+    try:
+        proc = seg_ff(shard, seg_output, SNR, segment_path, wait = False)
+        n_files = stream_tar(proc, seg_output, part + '.part', 'none', rename = lambda name: rename_shard_member(name, shard_code, avi_date_code, offset))
+        os.replace(part + '.part', part)
+    except Exception:
+        if os.path.isfile(part + '.part'):
+            os.remove(part + '.part')
+        open(part + '.failed', 'w').close() # lets the last shard give up on the AVI instead of waiting for this one
+        merge_shards(avi, n_shards)
+        raise
+    finally:
+        scratch_space.release(shard_code + "_s") # also if segment or the archive failed
+    timer_seg = time() - timer_seg
+    logger.debug(f"Segmentation executable took {timer_seg:.3f} s.")
+    logger.info(f'Streamed {n_files} files into {part}.')
+
+    os.remove(shard)
+    return merge_shards(avi, n_shards)
+
+
+def segment_job(job):
+    """Pool entry point: a whole AVI path or a shard tuple from cut_shards.
+
+    A failure is logged here, where the job is known, and raised again for the pool.
+    """
+    try:
+        if isinstance(job, tuple):
+            return local_shard(job)
+        return local_main(job)
+    except Exception as e:
+        name = os.path.basename(job[1] or job[0]) if isinstance(job, tuple) else os.path.basename(job)
+        logger.error(f"Segmentation of {name} failed: {e}")
+        raise
+
+
+def outcomes(results):
+    """(result, error) for every job of a pool's imap iterator, so one failed job does not end the loop."""
+    while True:
+        try:
+            yield next(results), None
+        except StopIteration:
+            return
+        except Exception as e:
+            yield None, e
+
+
+def job_path(job):
+    """The AVI a segmentation job (or planned shard) reads."""
+    return job[0] if isinstance(job, tuple) else job
+
+
+def job_name(job):
+    """Name of the file a job segments, as logged: the AVI or its shard."""
+    if isinstance(job, tuple):
+        return f"{os.path.splitext(os.path.basename(job[0]))[0]}-shard{job[1]:03d}.avi"
+    return os.path.basename(job)
+
+
+def job_share(job):
+    """Part of its AVI a job covers: 1, or the planned frames of a shard over those of the AVI."""
+    if not isinstance(job, tuple):
+        return 1
+    avi, index, n_shards, n_frames = job
+    return min(shard_frames, n_frames - index * shard_frames) / n_frames
+
+
+def footprint(job):
+    """Estimated scratch bytes of a job: its crops (unless streamed) and, for a shard, its piece of video."""
+    return os.path.getsize(job_path(job)) * job_share(job) * (scratch_ratio + isinstance(job, tuple))
+
+
+def plan_jobs(jobs, all_avis, workers):
+    """Order jobs longest-first (shards next to each other) and print the predicted run time and peak scratch.
+
+    Costs are frames from ffprobe when sharding (already counted by shard_jobs),
+    otherwise or if any AVI could not be counted bytes, scaled by the timer_seg
+    times logged by earlier runs in segment_dir. Also sets the scratch_ratio
+    used for the scratch reservations of the workers.
+    """
+    global scratch_ratio
+    if shard_frames > 0 and all([count_frames(job_path(job)) is not None for job in jobs]):
+        units, unit = (lambda job: count_frames(job_path(job)) * job_share(job)), 'frames'
+    else:
+        units, unit = (lambda job: os.path.getsize(job_path(job)) * job_share(job)), 'bytes'
+
+    logs = glob.glob(glob.escape(segment_dir) + '/segmentation_*.log') + glob.glob(glob.escape(segment_dir) + '/plankline_*.log')
+    timings = scheduler.logged_timings(logs, 'avi_file:', 'Segmentation executable took')
+    costs, rate = scheduler.estimate_costs(jobs, units, job_name, timings, reference = all_avis)
+
+    # Crops wait on scratch for the whole AVI unless streamed; shards also hold their piece of video.
+    scratch_ratio = 0 if stream_archive else scheduler.output_ratio(manifest.load(segment_dir))
+    footprints = [footprint(job) for job in jobs]
+
+    plan = scheduler.summary(costs, rate, workers, footprints, unit)
+    logger.info(plan)
+    print(plan)
+    # The shards of an AVI stay together: its scratch is held until all of them are merged,
+    # so cutting another AVI first could wait forever for that space.
+    return scheduler.grouped_longest_first(jobs, costs, job_path)
+
+
+def dir_size(path):
+    """Total size in bytes of the files below path."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, f))
+            except FileNotFoundError:
+                continue
+    return total
+
+
+def benchmark_grid():
+    """Every combination of the [benchmark] lists; keys not given keep their [segmentation] value."""
+    values = []
+    for key in BENCHMARK_SETTINGS:
+        if config.has_option('benchmark', key):
+            values.append([v.strip() for v in config['benchmark'][key].split(',')])
+        else:
+            values.append([config['segmentation'][key]])
+    return [dict(zip(BENCHMARK_SETTINGS, combo)) for combo in itertools.product(*values)]
+
+
+def sample_avis(avis, n, frames):
+    """n AVIs spread evenly over the transect, cut to their first frames if frames > 0."""
+    avis = sorted(avis)
+    step = max(1, len(avis) // n)
+    sample = avis[::step][:n]
+    if frames <= 0:
+        return sample
+
+    clips = []
+    clip_dir = fast_scratch + "/benchmark"
+    os.makedirs(clip_dir, permis, exist_ok = True)
+    for avi in sample:
+        clip = clip_dir + "/" + os.path.basename(avi)
+        subprocess.run([ffmpeg, '-v', 'error', '-y', '-i', avi, '-map', '0:v:0', '-c', 'copy', '-frames:v', str(frames), clip], check = True)
+        clips.append(clip)
+    return clips
+
+
+def benchmark_job(job):
+    """Run segment once on an AVI with one setting and measure it.
+
+    Scratch use is sampled every stream_interval seconds while segment runs.
+    """
+    index, settings, avi = job
+    avi_date_code = os.path.splitext(os.path.basename(avi))[0]
+    seg_output = f"{fast_scratch}/bench{index:03d}-{avi_date_code}_s"
+    os.makedirs(seg_output, permis, exist_ok = True)
+
+    timer_seg = time()
+    proc = seg_ff(avi, seg_output, settings['signal_to_noise'], segment_path, wait = False, settings = settings)
+    peak = 0
+    while proc.poll() is None:
+        peak = max(peak, dir_size(seg_output))
+        sleep(stream_interval)
+    timer_seg = time() - timer_seg
+
+    n_files = 0
+    n_crops = 0
+    for dirpath, dirnames, filenames in os.walk(seg_output):
+        n_files += len(filenames)
+        n_crops += len([f for f in filenames if is_crop(f)])
+    n_bytes = dir_size(seg_output)
+    shutil.rmtree(seg_output)
+
+    frames = count_frames(avi)
+    return dict(settings, setting = index, avi = os.path.basename(avi), frames = frames, seconds = f"{timer_seg:.2f}",
+        frames_per_s = f"{frames / timer_seg:.2f}" if frames is not None else '', crops = n_crops, files = n_files, bytes = n_bytes, scratch_peak = max(peak, n_bytes))
+
+
+def benchmark(avis):
+    """Segment a sample of avis over the [benchmark] grid and write benchmark_<session>.csv."""
+    n_sample = int(config['benchmark'].get('sample', fallback = '3')) if config.has_section('benchmark') else 3
+    frames = int(config['benchmark'].get('frames', fallback = '0')) if config.has_section('benchmark') else 0
+    grid = benchmark_grid()
+    sample = sample_avis(avis, n_sample, frames)
+    jobs = [(i, settings, avi) for i, settings in enumerate(grid) for avi in sample]
+
+    print(f"Benchmarking {len(grid)} settings on {len(sample)} AVIs ({len(jobs)} runs, {num_processes} at a time).")
+    logger.info(f"Benchmark grid: {grid}")
+
+    p = Pool(num_processes)
+    results = []
+    for result in tqdm.tqdm(p.imap_unordered(benchmark_job, jobs), total = len(jobs)):
+        results.append(result)
+    p.close()
+    p.join()
+
+    results.sort(key = lambda r: (r['setting'], r['avi']))
+    bench_file = segment_dir + '/benchmark_' + session_id + '.csv'
+    fields = ['setting'] + BENCHMARK_SETTINGS + ['avi', 'frames', 'seconds', 'frames_per_s', 'crops', 'files', 'bytes', 'scratch_peak']
+    with open(bench_file, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = fields)
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info(f"Benchmark results written to {bench_file}")
+
+    print(f"{'setting':>7} {'frames/s':>9} {'crops':>9} {'GB':>7} {'peak GB':>8}  settings")
+    for i, settings in enumerate(grid):
+        runs = [r for r in results if r['setting'] == i]
+        seconds = sum([float(r['seconds']) for r in runs])
+        frames_per_s = sum([r['frames'] for r in runs]) / seconds if seconds > 0 else 0
+        print(f"{i:>7} {frames_per_s:>9.1f} {sum([r['crops'] for r in runs]):>9} {sum([r['bytes'] for r in runs])/10**9:>7.2f} {max([r['scratch_peak'] for r in runs])/10**9:>8.2f}  "
+            + ' '.join([f"{key}={settings[key]}" for key in BENCHMARK_SETTINGS]))
+    print(f"Results in {bench_file}")
+
 
 def local_main(avi):
     """A single threaded function that takes one avi path."""
@@ -73,9 +578,11 @@ def local_main(avi):
     # setup all of the local paths for the avi
     avi_file = os.path.basename(avi) # get only the file part of the full path
     avi_date_code = os.path.splitext(avi_file)[0] # remove .avi
-    avi_segment_scratch = fast_scratch + "/" + avi_date_code
-    seg_output = avi_segment_scratch + "_s"
-    out_dir = segment_dir + "/" + avi_date_code
+    sig = manifest.signature(avi, settings_hash)
+
+    # Wait for room on scratch (RAM first, then the spill locations).
+    seg_output = scratch_space.reserve(avi_date_code + "_s", footprint(avi), logger)
+    avi_segment_scratch = seg_output[:-len("_s")]
 
     logger.info(f'avi_file: {avi_file}')
     logger.info(f'avi_date_code: {avi_date_code}')
@@ -83,7 +590,6 @@ def local_main(avi):
     logger.info(f'seg_output: {seg_output}')
     logger.info(f'segment_dir: {segment_dir}')
     logger.info(f"Current ram usage (GB): {psutil.virtual_memory()[3]/1000000000:.2f}")
-    logger.info(f"Current cpu usage (%): {psutil.cpu_percent(4):.1f}")
     
 
     logger.debug(f'Starting AVI file: {avi_file}')
@@ -91,43 +597,94 @@ def local_main(avi):
     # Create necessary directory structure.
     logger.info('Setting up AVI directories.')
     os.makedirs(avi_segment_scratch, permis, exist_ok=True)
-    os.makedirs(seg_output, permis, exist_ok=True)
 
-    # Segmentation.
-    logger.info('Starting segmentation.')
-    timer_seg = time()
-    seg_ff(avi, seg_output, SNR, segment_path)
-    timer_seg = time() - timer_seg
-    logger.debug(f"Segmentation executable took {timer_seg:.3f} s.")
-
-    if config['general']['compress_output'] == 'True':
-        logger.info('Start tarring+compressing.')
-        tar_name = out_dir + ".tar.gz"
-        tar = f'tar czf \"{tar_name}\" -C \"{seg_output}\" .'
-        logger.debug(tar)
-        
-        timer_tar = time()
-        os.system(tar)
+    try:
+        # Write to a .part file and rename once complete so a crash never leaves a tar that looks finished.
+        tar_name = tar_path(avi)
+        part_name = tar_name + ".part"
+
+        if stream_archive:
+            # Segmentation and archiving run together.
+            logger.info('Starting segmentation with streaming archive.')
+            timer_seg = time()
+            proc = seg_ff(avi, seg_output, SNR, segment_path, wait = False)
+            n_files = stream_tar(proc, seg_output, part_name, archive_codec, index_file = archive.index_path(tar_name))
+            timer_seg = time() - timer_seg
+            logger.debug(f"Segmentation executable took {timer_seg:.3f} s.")
+            logger.info(f'Streamed {n_files} files into {tar_name}.')
+        else:
+            # Segmentation.
+            logger.info('Starting segmentation.')
+            timer_seg = time()
+            seg_ff(avi, seg_output, SNR, segment_path)
+            timer_seg = time() - timer_seg
+            logger.debug(f"Segmentation executable took {timer_seg:.3f} s.")
+
+            logger.info(f'Start tarring ({archive_codec}).')
+            tar = f'tar {archive.create_option(archive_codec, archive_level, archive_threads)} -cf \"{part_name}\" -C \"{seg_output}\" .'
+            logger.debug(tar)
+
+            timer_tar = time()
+            os.system(tar)
+            timer_tar = time() - timer_tar
+
+            logger.info(f'End tarring in {timer_tar:.3f} s.')
+
+            archive.build_index(part_name, archive.index_path(tar_name))
+
+        os.replace(part_name, tar_name)
         os.chmod(tar_name, permis)
-        timer_tar = time() - timer_tar
+        os.chmod(archive.index_path(tar_name), permis)
+        remove_superseded(avi)
+        catalog.add_tar(segment_dir, tar_name, avi)
+        manifest.record(segment_dir, avi, sig, tar_name)
+    finally:
+        scratch_space.release(avi_date_code + "_s") # remove datecode_s/ as soon as the tar is in place, or once segmenting failed
+        shutil.rmtree(avi_segment_scratch, ignore_errors = True) # remove datecode/
+    logger.info('End local_main.')
+    return tar_name
 
-        logger.info(f'End tarring+compressing in {timer_tar:.3f} s.')
-    else:
-        logger.info('Start tarring')
-        tar_name = out_dir + ".tar"
-        tar = f'tar cf \"{tar_name}\" -C \"{seg_output}\" .'
-        logger.debug(tar)
 
-        timer_tar = time()
-        os.system(tar)
-        os.chmod(tar_name, permis)
-        timer_tar = time() - timer_tar
+def configure(cfg, directory, sid):
+    """Set the module level settings used by local_main from a parsed config.
 
-        logger.info(f'End tarring in {timer_tar:.3f} s.')
+    directory is the raw AVI directory. Called from __main__ and from
+    plankline.py when segmentation runs alongside classification.
+    """
+    global config, session_id, basename, permis, SNR, num_processes, segment_path, fast_scratch
+    global stream_archive, stream_interval, raw_dir, working_dir, segment_dir, resume, settings_hash
+    global ffmpeg, ffprobe, shard_frames, archive_codec, archive_level, archive_threads, scratch_space, scratch_ratio
+    config = cfg
+    session_id = sid
 
-    shutil.rmtree(seg_output)          # remove datecode_s/
-    shutil.rmtree(avi_segment_scratch) # remove datecode/
-    logger.info('End local_main.')
+    ## Read in config options:
+    basename = config['segmentation']['segment_basename']
+    permis = int(config['general']['dir_permissions'])
+    SNR = int(config['segmentation']['signal_to_noise'])
+    num_processes = int(config['segmentation']['segment_processes'])
+    segment_path = config['segmentation']['segment'] # TBK: Absolute path to segmentation executable.
+    fast_scratch = config['segmentation']['fast_scratch'] # TBK: Fastest IO option for temporary files.
+    stream_archive = config['segmentation'].getboolean('stream_archive', fallback = False)
+    stream_interval = float(config['segmentation'].get('stream_interval', fallback = '2'))
+    resume = config['general'].getboolean('resume', fallback = False)
+    settings_hash = manifest.config_hash(config, 'segmentation', SEGMENT_SETTINGS)
+    ffmpeg = config['general']['ffmpeg']
+    ffprobe = config['general']['ffprobe']
+    shard_frames = int(config['segmentation'].get('shard_frames', fallback = '0'))
+    archive_codec, archive_level, archive_threads = archive.codec_settings(config)
+    
+    ## Determine directories
+    raw_dir = os.path.abspath(directory) # /media/plankline/Data/raw/Camera1/Transect1
+    working_dir = raw_dir.replace("raw", "analysis") # /media/plankline/Data/analysis/Camera1/Transect1
+    working_dir = working_dir.replace("camera0/", "camera0/segmentation/") # /media/plankline/Data/analysis/Camera1/Transect1
+    working_dir = working_dir.replace("camera1/", "camera1/segmentation/") # /media/plankline/Data/analysis/Camera1/segmentation/Transect1
+    working_dir = working_dir.replace("camera2/", "camera2/segmentation/") # /media/plankline/Data/analysis/Camera1/segmentation/Transect1
+    working_dir = working_dir.replace("camera3/", "camera3/segmentation/") # /media/plankline/Data/analysis/Camera1/segmentation/Transect1
+    
+    segment_dir = working_dir + f"({basename})" # /media/plankline/Data/analysis/segmentation/Camera1/segmentation/Transect1(reg)
+    fast_scratch = fast_scratch + "/segment-" + session_id
+    scratch_space = scratch.from_config(config, 'segmentation', "segment-" + session_id, permis)
+    scratch_ratio = 0 if stream_archive else 1 # until plan_jobs has looked at earlier outputs
 
 
 if __name__ == "__main__":
@@ -141,6 +698,7 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Segmentation tool for the plankton pipeline. Uses ffmpeg and seg_ff to segment a video into crops of plankton")
     parser.add_argument("-c", "--config", required = True, help = "Configuration ini file.")
     parser.add_argument("-d", "--directory", required = True, help = "Input directory containing ./raw/")
+    parser.add_argument("-b", "--benchmark", action = "store_true", help = "Segment a sample of AVIs over the [benchmark] settings grid and report throughput instead of segmenting the transect.")
 
     # read in the arguments
     args = parser.parse_args()
@@ -156,24 +714,7 @@ if __name__ == "__main__":
         print(f"No logging:config specified in {args.config}. Aborting!")
         exit()
 
-    ## Read in config options:
-    basename = config['segmentation']['segment_basename']
-    permis = int(config['general']['dir_permissions'])
-    SNR = int(config['segmentation']['signal_to_noise'])
-    num_processes = int(config['segmentation']['segment_processes'])
-    segment_path = config['segmentation']['segment'] # TBK: Absolute path to segmentation executable.
-    fast_scratch = config['segmentation']['fast_scratch'] # TBK: Fastest IO option for temporary files.
-    
-    ## Determine directories
-    raw_dir = os.path.abspath(args.directory) # /media/plankline/Data/raw/Camera1/Transect1
-    working_dir = raw_dir.replace("raw", "analysis") # /media/plankline/Data/analysis/Camera1/Transect1
-    working_dir = working_dir.replace("camera0/", "camera0/segmentation/") # /media/plankline/Data/analysis/Camera1/Transect1
-    working_dir = working_dir.replace("camera1/", "camera1/segmentation/") # /media/plankline/Data/analysis/Camera1/segmentation/Transect1
-    working_dir = working_dir.replace("camera2/", "camera2/segmentation/") # /media/plankline/Data/analysis/Camera1/segmentation/Transect1
-    working_dir = working_dir.replace("camera3/", "camera3/segmentation/") # /media/plankline/Data/analysis/Camera1/segmentation/Transect1
-    
-    segment_dir = working_dir + f"({basename})" # /media/plankline/Data/analysis/segmentation/Camera1/segmentation/Transect1(reg)
-    fast_scratch = fast_scratch + "/segment-" + session_id
+    configure(config, args.directory, session_id)
 
     os.makedirs(segment_dir, permis, exist_ok = True)
     os.makedirs(fast_scratch, permis, exist_ok = True)
@@ -202,7 +743,8 @@ if __name__ == "__main__":
     print(f"Number of processes: {num_processes}")
     print(f"SNR: {SNR}")
     print(f"Log configuration file: {config['logging']['config']}")
-    print(f"Compressing output: {config['general']['compress_output'] == 'True'}")
+    print(f"Archive codec: {archive_codec} (level {archive_level})")
+    print(f"Streaming archive: {stream_archive}")
 
     # Check the permissions
     if os.access(segment_dir, os.W_OK) == False:
@@ -227,24 +769,54 @@ if __name__ == "__main__":
         logger.error(f"No avi files found in machine_scratch/raw make sure avi files are in {raw_dir}.")
         exit()
 
+    if args.benchmark:
+        benchmark(avis)
+        shutil.rmtree(fast_scratch, ignore_errors=True)
+        exit()
+
+    all_avis = avis
+    if resume:
+        n_avis = len(avis)
+        avis = pending(avis)
+        logger.info(f"Resuming: {n_avis - len(avis)} AVI files already segmented.")
+        print(f"Resuming: skipping {n_avis - len(avis)} AVI files that are already segmented.")
+
+    jobs = avis
+    if shard_frames > 0:
+        logger.info(f"Sharding AVIs longer than {shard_frames} frames.")
+        jobs = shard_jobs(avis)
+        print(f"Segmenting {len(jobs)} AVIs and shards.")
+    jobs = plan_jobs(jobs, all_avis, num_processes)
+
     # Parallel portion of the code.
     logger.info("Starting multithreaded segmentation call.")
     p = Pool(num_processes)
 
+    # Resource usage is sampled from this process so the workers never block on it.
+    sampler = monitor.Sampler(segment_dir, 'segmentation', session_id, float(config['general'].get('monitor_interval', fallback = '0')), fast_scratch)
+    sampler.start()
+
     # TBK:
     timer_pool = time()
-    for _ in tqdm.tqdm(p.imap_unordered(local_main, avis), total = len(avis)):
-        pass
+    failed = 0
+    for tar_name, error in tqdm.tqdm(outcomes(p.imap_unordered(segment_job, cut_shards(jobs))), total = len(jobs)):
+        if error is not None: # logged by segment_job
+            failed += 1
     timer_pool = time() - timer_pool
 
     p.close()
     p.join() # blocks so that we can wait for the processes to finish
+    sampler.stop()
 
     logger.debug(f"Finished segmentation in {timer_pool:.3f} s.")
     print(f"Finished segmentation in {timer_pool:.1f} seconds.")
+    if failed > 0:
+        logger.error(f"{failed} of {len(jobs)} segmentation jobs failed.")
+        print(f"{failed} of {len(jobs)} segmentation jobs failed, see the log.")
 
     logger.debug(f"Deleting temporary directory {fast_scratch}.")
     shutil.rmtree(fast_scratch, ignore_errors=True)
+    scratch_space.remove_all()
 
     logger.debug("Done.")
     
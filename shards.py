@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""Sharded training sets for UAF-Plankline
+    A training set of many thousands of small image files is slow to copy
+    and slow to load. pull_all can instead pack the images it selects into a
+    few size-bounded, uncompressed shards:
+
+        shard-00000.tar             the images, stored once each
+        shard-00000.tar.idx         offset and size of every image (see archive.py)
+        shard-00000.labels.csv      member, taxon and file of every image and taxon it matched
+        shards.csv                  shard, images and bytes of every shard
+
+    Shards move and read at sequential I/O speed. ./shards.py expands them
+    back into the <taxon>/<image> folders that SCNN trains from.
+
+Usage:
+    import shards
+    with shards.ShardWriter(out_dir, max_bytes) as writer:
+        writer.add(data, [(taxon, file), ...])
+    ./shards.py <shard directory> <training set Data directory>
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import io
+import os
+import csv
+import tarfile
+import argparse
+from time import time
+
+import archive
+
+SHARD_LIST = 'shards.csv'
+
+
+def labels_path(shard):
+    return os.path.join(os.path.dirname(shard), archive.strip_extension(shard) + '.labels.csv')
+
+
+def read_labels(shard):
+    """{member: [(taxon, file)]} from the label manifest of a shard."""
+    labels = {}
+    with open(labels_path(shard), newline = '') as f:
+        reader = csv.reader(f)
+        next(reader)
+        for member, taxon, file in reader:
+            labels.setdefault(member, []).append((taxon, file))
+    return labels
+
+
+def list_shards(shard_dir):
+    """Shard files of a directory, from shards.csv when there is one."""
+    listing = os.path.join(shard_dir, SHARD_LIST)
+    if os.path.isfile(listing):
+        with open(listing, newline = '') as f:
+            return [os.path.join(shard_dir, row['shard']) for row in csv.DictReader(f)]
+    return sorted([os.path.join(shard_dir, f) for f in os.listdir(shard_dir) if archive.is_archive(f)])
+
+
+def tar_size(entry_bytes):
+    """Size of a tar holding entry_bytes of headers and padded data: two end blocks, rounded up to whole records."""
+    return -(-(entry_bytes + 2 * tarfile.BLOCKSIZE) // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+class ShardWriter:
+    """Packs images into <prefix>-NNNNN.tar shards of at most max_bytes on disk (a larger image gets a shard of its own)."""
+
+    def __init__(self, out_dir, max_bytes, prefix = 'shard'):
+        self.out_dir = out_dir
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.shards = [] # (shard, images, bytes) of finished shards
+        self._writer = None
+
+    def _open(self):
+        self._path = os.path.join(self.out_dir, '%s-%05d.tar' % (self.prefix, len(self.shards)))
+        self._writer = archive.Writer(self._path + '.part', index_file = archive.index_path(self._path))
+        self._tar = self._writer.__enter__()
+        self._labels = [] # (member, taxon, file)
+        self._images = 0
+        self._bytes = 0
+
+    def _finish(self):
+        self._writer.__exit__(None, None, None)
+        os.replace(self._path + '.part', self._path)
+        with open(labels_path(self._path) + '.part', 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['member', 'taxon', 'file'])
+            writer.writerows(self._labels)
+        os.replace(labels_path(self._path) + '.part', labels_path(self._path))
+        self.shards.append((os.path.basename(self._path), self._images, os.path.getsize(self._path)))
+        self._writer = None
+
+    def add(self, data, files):
+        """Store one image; files lists the (taxon, relative file) it expands to, the first is its member name."""
+        member = files[0][1]
+        info = tarfile.TarInfo(member)
+        info.size = len(data)
+        info.mtime = int(time())
+        info.mode = 0o644
+        # header blocks (more than one for long names) and padded data
+        entry = len(info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')) + -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        if self._writer is not None and self._images > 0 and tar_size(self._bytes + entry) > self.max_bytes:
+            self._finish()
+        if self._writer is None:
+            self._open()
+
+        self._tar.addfile(info, io.BytesIO(data))
+        self._labels += [(member, taxon, file) for taxon, file in files]
+        self._images += 1
+        self._bytes += entry
+
+    def close(self):
+        """Finish the last shard and write shards.csv."""
+        if self._writer is not None:
+            self._finish()
+        listing = os.path.join(self.out_dir, SHARD_LIST)
+        with open(listing + '.part', 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['shard', 'images', 'bytes'])
+            writer.writerows(self.shards)
+        os.replace(listing + '.part', listing)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+
+def expand(shard_dir, out_dir):
+    """Write every image of the shards in shard_dir to out_dir/<taxon>/<image>. Returns the number of files written."""
+    made = set()
+    n = 0
+    for shard in list_shards(shard_dir):
+        labels = read_labels(shard)
+        for member, data in archive.read_matching(shard, lambda name: name in labels):
+            for taxon, file in labels[member]:
+                if taxon not in made:
+                    os.makedirs(os.path.join(out_dir, taxon), exist_ok = True)
+                    made.add(taxon)
+                with open(os.path.join(out_dir, file), 'wb') as f:
+                    f.write(data)
+                n += 1
+    return n
+
+
+if __name__ == "__main__":
+    """Expand shards into the folder layout of a training set."""
+
+    parser = argparse.ArgumentParser(description="Expands shards written by pull_all.py -f shards into <taxon>/<image> folders.")
+    parser.add_argument("shards", help = "Directory of the shards (with shards.csv).")
+    parser.add_argument("output", help = "Directory to expand into, e.g. the Data folder of a training set.")
+    args = parser.parse_args()
+
+    print(f"Wrote {expand(args.shards, args.output)} images to {args.output}")
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Training set staging for UAF-Plankline
+    SCNN reads every training image each epoch, so train.py copies the
+    training set from model_dir (often network or spinning storage) to the
+    [training] fast_scratch location (ideally RAM backed, e.g. /dev/shm) and
+    trains from there. The staged copy is kept between runs and synced
+    incrementally: a file is only copied if its content changed, so
+    retraining after adding a few hundred images copies just those.
+
+    A manifest in the staged directory records the size, mtime and content
+    hash of every file. Files whose size and mtime are unchanged are not
+    read; others are hashed and copied only if the hash differs.
+
+Usage:
+    import stage
+    copied, removed, total = stage.sync(src, dst)
+    ./stage.py <model_dir> <fast_scratch>
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import json
+import shutil
+import argparse
+from multiprocessing.pool import ThreadPool
+
+from cache import content_hash
+
+MANIFEST_NAME = '.stage_manifest.json'
+
+
+def stage_path(fast_scratch, model_dir):
+    """Staged copy of a training set: one directory per model_dir, kept between runs."""
+    return os.path.join(fast_scratch, 'plankline-train', os.path.basename(os.path.abspath(model_dir)))
+
+
+def scan(root, exclude = ()):
+    """{relative path: (size, mtime_ns)} of every file below the subdirectories of root, except those in exclude."""
+    files = {}
+    if not os.path.isdir(root):
+        return files
+    for top in sorted(os.listdir(root)):
+        if top in exclude or not os.path.isdir(os.path.join(root, top)):
+            continue # top level files are logs and configs, not training data
+        for path, dirs, names in os.walk(os.path.join(root, top)):
+            for name in names:
+                full = os.path.join(path, name)
+                st = os.stat(full)
+                files[os.path.relpath(full, root)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def load_manifest(dst):
+    path = os.path.join(dst, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return {} # everything is checked again
+
+
+def save_manifest(dst, manifest):
+    path = os.path.join(dst, MANIFEST_NAME)
+    with open(path + '.part', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.part', path)
+
+
+def copy_file(src, dst):
+    """Copy src to dst through a .part file, so dst is never partial."""
+    os.makedirs(os.path.dirname(dst), exist_ok = True)
+    shutil.copy2(src, dst + '.part')
+    os.replace(dst + '.part', dst)
+
+
+def size(src, exclude = ()):
+    return sum([s for s, mtime in scan(src, exclude).values()])
+
+
+def sync(src, dst, exclude = (), threads = 8):
+    """Make the subdirectories of dst (except exclude) identical to those of src. Returns (copied, removed, total) files."""
+    os.makedirs(dst, exist_ok = True)
+    old = load_manifest(dst)
+    staged = scan(dst, exclude)
+    manifest = {}
+    to_copy = []
+    for rel, (s, mtime) in scan(src, exclude).items():
+        entry = old.get(rel)
+        present = rel in staged and staged[rel][0] == s
+        if entry is not None and present and entry['size'] == s and entry['mtime'] == mtime:
+            manifest[rel] = entry
+            continue
+        h = content_hash(os.path.join(src, rel))
+        manifest[rel] = {'size': s, 'mtime': mtime, 'hash': h}
+        if entry is None or not present or entry['hash'] != h:
+            to_copy.append(rel)
+
+    with ThreadPool(threads) as pool:
+        pool.map(lambda rel: copy_file(os.path.join(src, rel), os.path.join(dst, rel)), to_copy)
+
+    removed = [rel for rel in staged if rel not in manifest]
+    for rel in removed:
+        os.remove(os.path.join(dst, rel))
+    save_manifest(dst, manifest)
+    return len(to_copy), len(removed), len(manifest)
+
+
+if __name__ == "__main__":
+    """Stage (or refresh) a training set ahead of training."""
+
+    parser = argparse.ArgumentParser(description="Copies the training images of a model_dir to fast scratch, only copying what changed.")
+    parser.add_argument("model_dir", help = "Training set (the [training] model_dir).")
+    parser.add_argument("fast_scratch", help = "Scratch location (the [training] fast_scratch).")
+    args = parser.parse_args()
+
+    dst = stage_path(args.fast_scratch, args.model_dir)
+    copied, removed, total = sync(args.model_dir, dst, exclude = ('weights',))
+    print(f"Staged {total} files in {dst}: {copied} copied, {removed} removed")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""Transect results store for UAF-Plankline
+    Merges the per-tar classification results of one transect and model into
+    a single SQLite database, results.sqlite in the classification directory.
+    Every crop gets one row with its source tar, frame number, top class and
+    top probability, indexed on class and probability, so questions like "all
+    copepods above 0.8" are one query instead of a scan over every csv.
+
+        crops(name, tar, frame, class, prob)
+        sources(tar, result, size, mtime, model)
+
+    The store is updated incrementally from the classification manifest: a
+    tar is (re)loaded only if its result file changed since it was added.
+
+Usage:
+    import store
+    store.update(classification_dir)
+    ./store.py <classification dir> [-t <class> ...] [-p <min probability>]
+
+License:
+    MIT License
+
+    Copyright (c) 2023 Thomas Kelly
+
+    Permission is hereby granted, free of charge, to any person obtaining a copy
+    of this software and associated documentation files (the "Software"), to deal
+    in the Software without restriction, including without limitation the rights
+    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+    copies of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be included in all
+    copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+    SOFTWARE.
+"""
+
+import os
+import sqlite3
+import argparse
+import numpy as np
+
+import archive
+import catalog
+import manifest
+import results
+
+STORE_NAME = 'results.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (tar TEXT PRIMARY KEY, result TEXT, size INTEGER, mtime INTEGER, model TEXT);
+CREATE TABLE IF NOT EXISTS crops (name TEXT, tar TEXT, frame INTEGER, class TEXT, prob REAL);
+CREATE INDEX IF NOT EXISTS crops_class_prob ON crops (class, prob);
+CREATE INDEX IF NOT EXISTS crops_prob ON crops (prob);
+CREATE INDEX IF NOT EXISTS crops_tar ON crops (tar);
+"""
+
+
+def store_path(directory):
+    return os.path.join(directory, STORE_NAME)
+
+
+def connect(path):
+    """Open (creating if needed) a store."""
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL') # readers (pull_all, analysis) are not blocked by an update
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def add(conn, tar, result, model = None):
+    """Replace the crops of tar with the top class of every row in result (csv or npy)."""
+    names, classes, probs = results.load(result)
+    tar = os.path.basename(tar)
+    tar_id = archive.strip_extension(tar)
+
+    probs = np.asarray(probs)
+    if len(names) > 0:
+        top = probs.argmax(axis = 1)
+        top_prob = probs[np.arange(len(names)), top].astype(float)
+    else:
+        top, top_prob = [], []
+
+    rows = []
+    for name, col, prob in zip(names, top, top_prob):
+        name = os.path.basename(name)
+        rows.append((name, tar, catalog.frame_number(name, tar_id), classes[col], prob))
+
+    with conn: # one transaction per tar
+        conn.execute('DELETE FROM crops WHERE tar = ?', (tar,))
+        conn.executemany('INSERT INTO crops VALUES (?, ?, ?, ?, ?)', rows)
+        conn.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)',
+            (tar, os.path.basename(result), os.path.getsize(result), int(os.path.getmtime(result)), model))
+    return len(rows)
+
+
+def update(directory, path = None):
+    """Add every result in the manifest of directory that is new or changed. Returns the number of tars added."""
+    conn = connect(path or store_path(directory))
+    known = {tar: (result, size, mtime) for tar, result, size, mtime in conn.execute('SELECT tar, result, size, mtime FROM sources')}
+
+    n = 0
+    for tar, entry in manifest.load(directory).items():
+        result = entry['output']
+        if not os.path.isfile(result):
+            continue
+        if known.get(tar) == (os.path.basename(result), os.path.getsize(result), int(os.path.getmtime(result))):
+            continue
+        add(conn, tar, result, entry['signature'].get('model'))
+        n += 1
+    conn.close()
+    return n
+
+
+def query(path, taxa = None, probability = 0, strict = True):
+    """(name, tar, frame, class, prob) of crops whose top class is one of taxa with prob above probability.
+
+    With strict False a taxon matches every class containing it (as in pull_all).
+    """
+    conn = connect(path)
+    sql = 'SELECT name, tar, frame, class, prob FROM crops WHERE prob > ?'
+    params = [probability]
+    if taxa:
+        if strict:
+            sql += f" AND class IN ({', '.join(['?'] * len(taxa))})"
+            params += list(taxa)
+        else:
+            sql += ' AND (' + ' OR '.join(["class LIKE ?"] * len(taxa)) + ')'
+            params += [f'%{taxon}%' for taxon in taxa]
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return rows
+
+
+if __name__ == "__main__":
+    """Update the store of a classification directory and optionally count matching crops."""
+
+    parser = argparse.ArgumentParser(description="Merges the per-tar classification results of a transect into results.sqlite.")
+    parser.add_argument("directory", help = "Classification directory (with manifest.jsonl).")
+    parser.add_argument("-t", "--taxon", nargs = '+', help = "Classes to count.")
+    parser.add_argument("-p", "--probability", type = float, default = 0, help = "Minimum top probability.")
+    parser.add_argument("-s", "--strict", action = "store_true", help = "Match class names exactly instead of as substrings.")
+    args = parser.parse_args()
+
+    print(f"Added {update(args.directory)} tars to {store_path(args.directory)}")
+    if args.taxon:
+        counts = {}
+        for name, tar, frame, cls, prob in query(store_path(args.directory), args.taxon, args.probability, args.strict):
+            counts[cls] = counts.get(cls, 0) + 1
+        for cls, n in sorted(counts.items()):
+            print(f"{cls}: {n}")
@@ -6,12 +6,29 @@
         
         e.g. python3 train.py -c config.ini
     
-    Importantly, teh script copies all data to a temporary scratch directory and 
-    then copies results back onces completed. If there is a failure then no model
-    epochs will be saved. The user is free to grab them from the scratch_dir.
+    With [training] stage, the script copies the training images to the
+    fast_scratch directory (only what changed since the last run) and trains
+    from there. The weights of every epoch are copied back to model_dir as
+    soon as they are saved, so a failure loses at most the epoch in progress.
+
+    Epochs start..stop are trained by one scnn process (or one per
+    epochs_per_run epochs). Its output is streamed into the per-epoch logs in
+    weights/ as it is written, and loss and accuracy are recorded in
+    weights/<basename>_metrics.csv. Ctrl-C stops once the current epoch is
+    saved; with [general] resume the next run continues from the last saved
+    epoch.
+
+    With [training] eval_dir, the weights of every epoch are evaluated on that
+    validation set while the next epoch trains (see evaluate.py), and the
+    best epoch is reported at the end.
+
+    With --sweep, every combination of the [sweep] settings is trained as
+    <basename>_sweepNN, each run on a free GPU, and the per-epoch timing and
+    metrics of all runs are summarised in <model_dir>/sweep_<session>.csv.
 
 Usage:
     ./train.py -c <config.ini>
+    ./train.py -c <config.ini> --sweep
 
 License:
     MIT License
@@ -37,20 +54,339 @@ License:
     SOFTWARE.
 """
 import os
-import sys
+import re
+import csv
 import shutil
+import signal
 import argparse
 import logging # TBK: logging module
 import logging.config # TBK
 import configparser # TBK: To read config file
-import tqdm # TBK
 import subprocess
+import threading
 from time import time
 import psutil
-from multiprocessing import Pool
+from multiprocessing import Pool, Manager
 import datetime
+import itertools
+
+import devices
+import evaluate
+import monitor
+import stage
+
+# SCNN prints its settings and the training set summary first; these lines only go to the log.
+HEADER_LINES = 76
+
+LOSS_PATTERN = r'(?:NLL|[Ll]oss)\s*[:=]?\s*([-+0-9.eE]+)'
+ACCURACY_PATTERN = r'[Aa]ccuracy\s*[:=]?\s*([0-9.]+)'
+
+stop_requested = False
+
+
+def request_stop(signum, frame):
+    """First Ctrl-C (or SIGTERM): stop once the current epoch is saved. Second: stop now."""
+    global stop_requested
+    if stop_requested:
+        raise KeyboardInterrupt
+    stop_requested = True
+    print("Stopping after the current epoch is saved (Ctrl-C again to stop now).")
+
+
+def weights_path(model_dir, basename, epoch):
+    return os.path.join(model_dir, 'weights', f"{basename}_epoch-{epoch}.cnn")
+
+
+def last_epoch(model_dir, basename):
+    """Highest epoch with saved weights, or None."""
+    pattern = re.compile(re.escape(basename) + r'_epoch-(\d+)\.cnn$')
+    weights_dir = os.path.join(model_dir, 'weights')
+    epochs = [int(m.group(1)) for m in [pattern.match(f) for f in os.listdir(weights_dir)] if m] if os.path.isdir(weights_dir) else []
+    return max(epochs) if len(epochs) > 0 else None
+
+
+def epoch_ranges(start, stop, per_run):
+    """[(first, last)] epochs trained by each scnn process; per_run 0 trains start..stop in one process."""
+    if start > stop:
+        return []
+    if per_run <= 0:
+        return [(start, stop)]
+    return [(i, min(i + per_run - 1, stop)) for i in range(start, stop + 1, per_run)]
+
+
+def train_call(scnn_cmd, model_dir, first, last, settings, device = '0'):
+    """scnn command training epochs first..last (same epochs as one -start i -stop i+1 call each)."""
+    return [scnn_cmd, '-project', model_dir, '-start', str(first), '-stop', str(last + 1), '-batchSize', settings['batchsize'],
+        '-basename', settings['basename'], '-vsp', settings['vsp'], '-lrd', settings['lrd'], '-ilr', settings['ilr'], '-cD', str(device)]
+
+
+def record_metrics(metrics_file, epoch, seconds, loss, accuracy):
+    """Append a row to the metrics csv (single write)."""
+    new = not os.path.isfile(metrics_file)
+    with open(metrics_file, 'a') as f:
+        f.write(('epoch,seconds,loss,accuracy\n' if new else '') + f"{epoch},{seconds:.1f},{'' if loss is None else loss},{'' if accuracy is None else accuracy}\n")
+
+
+def copy_weights(project, model_dir, basename, epoch):
+    """Copy the weights of epoch from the staged project back to model_dir."""
+    if project != model_dir:
+        stage.copy_file(weights_path(project, basename, epoch), weights_path(model_dir, basename, epoch))
+
+
+def run_epochs(call, model_dir, basename, first, last, patterns, logger, project = None, log_dir = None, echo = True, on_saved = None):
+    """Run one scnn process over epochs first..last, streaming its output into the per-epoch logs.
+
+    The epoch changes when scnn saves the weights of the next one; weights saved
+    in a staged project are copied back to model_dir right away. Logs and
+    metrics go to log_dir (model_dir/weights by default). on_saved(epoch) is
+    called with every epoch whose weights were saved. Returns (return code,
+    first epoch not yet saved, {epoch: seconds} of the epochs saved).
+    """
+    project = project or model_dir
+    log_dir = log_dir or os.path.join(model_dir, 'weights')
+    loss_re, accuracy_re = [re.compile(p) for p in patterns]
+    metrics_file = os.path.join(log_dir, basename + '_metrics.csv')
+    timer_run = time()
+    timer_epoch = time()
+    times = {}
+    epoch = first
+    log = open(os.path.join(log_dir, f"{basename}_epoch-{epoch}.log"), 'a')
+
+    # own session, so Ctrl-C reaches only this script and the epoch in progress can be finished
+    proc = subprocess.Popen(call, stdout = subprocess.PIPE, bufsize = 1, text = True, errors = 'replace', start_new_session = True)
+    try:
+        for n, line in enumerate(proc.stdout):
+            next_weights = weights_path(project, basename, epoch + 1)
+            if os.path.isfile(next_weights) and os.path.getmtime(next_weights) >= timer_run:
+                times[epoch] = time() - timer_epoch
+                logger.info(f"{basename} epoch {epoch} saved after {times[epoch]:.1f} s.")
+                copy_weights(project, model_dir, basename, epoch + 1)
+                if on_saved is not None:
+                    on_saved(epoch + 1)
+                epoch += 1
+                timer_epoch = time()
+                if stop_requested and epoch <= last:
+                    proc.terminate()
+                    break
+                if epoch <= last: # output after the last epoch stays in its log
+                    log.close()
+                    log = open(os.path.join(log_dir, f"{basename}_epoch-{epoch}.log"), 'a')
+
+            log.write(line)
+            log.flush()
+            line = line.rstrip('\n')
+            if n < HEADER_LINES or not echo:
+                logger.debug(line)
+            else:
+                print(line)
+
+            loss, accuracy = loss_re.search(line), accuracy_re.search(line)
+            if loss or accuracy:
+                loss = float(loss.group(1)) if loss else None
+                accuracy = float(accuracy.group(1)) if accuracy else None
+                record_metrics(metrics_file, epoch, time() - timer_epoch, loss, accuracy)
+                logger.debug(f"Epoch {epoch}: loss {loss}, accuracy {accuracy}")
+    except KeyboardInterrupt:
+        proc.kill()
+        logger.warning(f"Training stopped during epoch {epoch}; it restarts from the saved weights.")
+    finally:
+        if not log.closed:
+            log.close()
+        proc.stdout.close()
+        returncode = proc.wait()
+
+    next_weights = weights_path(project, basename, epoch + 1)
+    if os.path.isfile(next_weights) and os.path.getmtime(next_weights) >= timer_run:
+        times[epoch] = time() - timer_epoch
+        copy_weights(project, model_dir, basename, epoch + 1)
+        if on_saved is not None:
+            on_saved(epoch + 1)
+        epoch += 1 # saved with its last line of output
+    return returncode, epoch, times
+
+
+def resume_epoch(model_dir, basename, first, logger):
+    """Epoch to start from: the last one with saved weights if that is later than first."""
+    saved = last_epoch(model_dir, basename)
+    if saved is not None and saved > first:
+        logger.info(f"Resuming {basename} from the saved weights of epoch {saved}.")
+        return saved
+    return first
+
+
+def stage_training_set(config, model_dir, permis, logger):
+    """Sync the training set to fast_scratch if [training] stage is set; returns the project directory for scnn."""
+    if not config['training'].getboolean('stage', fallback = False):
+        return model_dir
+    fast_scratch = config['training'].get('fast_scratch', fallback = '/tmp')
+    stage_dir = stage.stage_path(fast_scratch, model_dir)
+    needed = stage.size(model_dir, exclude = ('weights', monitor.MONITOR_DIR)) - stage.size(stage_dir, exclude = ('weights', monitor.MONITOR_DIR))
+    if needed > shutil.disk_usage(fast_scratch).free:
+        logger.warning(f"Not enough room to stage the training set in {stage_dir}, training from {model_dir}.")
+        return model_dir
+
+    timer_stage = time()
+    copied, removed, total = stage.sync(model_dir, stage_dir, exclude = ('weights', monitor.MONITOR_DIR))
+    logger.info(f"Staged {total} files in {stage_dir} ({copied} copied, {removed} removed) in {time() - timer_stage:.1f} s.")
+    print(f"Staged training set in {stage_dir} ({copied} of {total} files copied).")
+    os.makedirs(os.path.join(stage_dir, 'weights'), permis, exist_ok = True)
+    return stage_dir
+
+
+def stage_weights(project, model_dir, basename, first):
+    """Copy the weights training starts from into a staged project."""
+    if project != model_dir and first > 0 and os.path.isfile(weights_path(model_dir, basename, first)):
+        stage.copy_file(weights_path(model_dir, basename, first), weights_path(project, basename, first))
 
 
+def train_epochs(scnn_cmd, model_dir, project, settings, first, stop, per_run, patterns, logger, device = '0', log_dir = None, echo = True, on_saved = None):
+    """Train epochs first..stop, per_run epochs per scnn process. Returns (completed, last saved epoch, {epoch: seconds})."""
+    basename = settings['basename']
+    all_times = {}
+    saved = first
+    for a, b in epoch_ranges(first, stop, per_run):
+        if stop_requested:
+            return False, saved, all_times
+        logger.info(f"Current ram usage (GB): {psutil.virtual_memory()[3]/1000000000:.2f}")
+
+        ## Format training call:
+        call = train_call(scnn_cmd, project, a, b, settings, device)
+        logger.info("Training call: " + ' '.join([f'\"{call[0]}\"'] + call[1:]))
+        if echo:
+            print(f"Starting training epochs {a} to {b}." if b > a else f"Starting training epoch {a}.")
+
+        returncode, saved, times = run_epochs(call, model_dir, basename, a, b, patterns, logger, project, log_dir, echo, on_saved)
+        all_times.update(times)
+        if stop_requested:
+            logger.info(f"Stopped {basename} with the weights of epoch {saved} saved.")
+            return False, saved, all_times
+        if returncode != 0:
+            logger.error(f"scnn exited with {returncode} during epoch {saved} of {basename}; rerun with resume = True to continue from the saved weights.")
+            if echo:
+                print(f"Training failed during epoch {saved}.")
+            return False, saved, all_times
+    return True, saved, all_times
+
+
+def eval_settings(config):
+    """(validation dir, eval GPU ids or None for the training GPU, jobs per GPU, scratch) or None without [training] eval_dir."""
+    validation_dir = config['training'].get('eval_dir', fallback = '').strip()
+    if validation_dir == '':
+        return None
+    listed = config['training'].get('eval_devices', fallback = '').strip()
+    ids = [int(d) for d in listed.split(',') if d.strip() != ''] if listed != '' else None
+    return validation_dir, ids, int(config['training'].get('eval_jobs', fallback = '1')), config['training'].get('fast_scratch', fallback = '/tmp')
+
+
+def make_evaluator(evaluation, scnn_cmd, project, basename, batchsize, log_dir, training_ids, logger):
+    """Evaluator writing log_dir/<basename>_eval.csv, or None if evaluation is None.
+
+    Without eval_devices the evaluations share training_ids, the GPUs used for training.
+    """
+    if evaluation is None:
+        return None
+    validation_dir, ids, jobs, scratch_dir = evaluation
+    gpus = devices.Devices({int(d): None for d in (ids or training_ids)}, slots = jobs)
+    return evaluate.Evaluator(scnn_cmd, project, basename, validation_dir, scratch_dir, gpus, batchsize, os.path.join(log_dir, basename + '_eval.csv'), logger)
+
+
+# [sweep] options and the train_call setting they override
+SWEEP_SETTINGS = {'initialLearningRate': 'ilr', 'learningRateDecay': 'lrd', 'batchsize': 'batchsize', 'validationSetRatio': 'vsp'}
+
+
+def sweep_grid(config, settings):
+    """Settings of every sweep run: every combination of the [sweep] lists (mode = grid) or their n-th values together (mode = list)."""
+    keys = [key for key in SWEEP_SETTINGS if config.has_option('sweep', key)]
+    values = [[v.strip() for v in config['sweep'][key].split(',')] for key in keys]
+    if config['sweep'].get('mode', fallback = 'grid') == 'list':
+        if len(set([len(v) for v in values])) > 1:
+            raise ValueError("With [sweep] mode = list every list needs the same number of values.")
+        combos = list(zip(*values))
+    else:
+        combos = list(itertools.product(*values))
+
+    runs = []
+    for i, combo in enumerate(combos):
+        run = dict(settings)
+        run.update({SWEEP_SETTINGS[key]: value for key, value in zip(keys, combo)})
+        run['basename'] = f"{settings['basename']}_sweep{i:02d}"
+        runs.append(run)
+    return runs
+
+
+def train_run(job, device):
+    """Pool entry point of a sweep: train one run on device, with its logs in log_dir.
+
+    saved is a queue shared with the parent, which evaluates every (epoch, basename, eval file)
+    put on it with the one evaluator of the sweep, or None without evaluation.
+    """
+    run, scnn_cmd, model_dir, project, first, stop, per_run, patterns, log_dir, saved_epochs = job
+    logger = logging.getLogger('sLogger')
+    os.makedirs(log_dir, exist_ok = True)
+    stage_weights(project, model_dir, run['basename'], first)
+    logger.info(f"Training {run['basename']} on device {device}.")
+
+    on_saved = None
+    if saved_epochs is not None:
+        on_saved = lambda epoch: saved_epochs.put((epoch, run['basename'], os.path.join(log_dir, run['basename'] + '_eval.csv')))
+    completed, saved, times = train_epochs(scnn_cmd, model_dir, project, run, first, stop, per_run, patterns, logger, device, log_dir, echo = False,
+        on_saved = on_saved)
+    with open(os.path.join(log_dir, run['basename'] + '_epochs.csv'), 'a') as f:
+        f.write(''.join([f"{epoch},{device},{seconds:.1f}\n" for epoch, seconds in sorted(times.items())]))
+    if not completed and not stop_requested:
+        raise RuntimeError(f"{run['basename']} failed during epoch {saved}")
+    return run['basename'], saved
+
+
+def read_epochs(log_dir, basename):
+    """{epoch: {device, seconds, loss, accuracy, val_accuracy}} of a sweep run: the last loss and accuracy scnn printed in
+    each epoch and the validation accuracy of the weights it saved."""
+    epochs = {}
+    epochs_file = os.path.join(log_dir, basename + '_epochs.csv')
+    if os.path.isfile(epochs_file):
+        with open(epochs_file) as f:
+            for line in f:
+                epoch, device, seconds = line.strip().split(',')
+                epochs[int(epoch)] = {'device': device, 'seconds': float(seconds), 'loss': '', 'accuracy': '', 'val_accuracy': ''}
+    eval_file = os.path.join(log_dir, basename + '_eval.csv')
+    if os.path.isfile(eval_file):
+        with open(eval_file, newline = '') as f:
+            for row in csv.DictReader(f): # weights of epoch N are saved at the end of training epoch N - 1
+                if int(row['epoch']) - 1 in epochs:
+                    epochs[int(row['epoch']) - 1]['val_accuracy'] = row['accuracy']
+    metrics_file = os.path.join(log_dir, basename + '_metrics.csv')
+    if os.path.isfile(metrics_file):
+        with open(metrics_file, newline = '') as f:
+            for row in csv.DictReader(f):
+                entry = epochs.setdefault(int(row['epoch']), {'device': '', 'seconds': '', 'loss': '', 'accuracy': '', 'val_accuracy': ''})
+                for key in ['loss', 'accuracy']:
+                    if row[key] != '':
+                        entry[key] = row[key]
+    return epochs
+
+
+def sweep_summary(runs, log_root, summary_file):
+    """Write one row per run and epoch to summary_file and print one line per run."""
+    fields = ['run', 'basename'] + list(SWEEP_SETTINGS) + ['epoch', 'device', 'seconds', 'loss', 'accuracy', 'val_accuracy']
+    rows = []
+    print(f"{'run':>4} {'epochs':>6} {'s/epoch':>8} {'loss':>9} {'accuracy':>9} {'best val':>9} {'epoch':>6}  settings")
+    for i, run in enumerate(runs):
+        epochs = read_epochs(os.path.join(log_root, run['basename']), run['basename'])
+        for epoch, entry in sorted(epochs.items()):
+            rows.append(dict(entry, run = i, basename = run['basename'], epoch = epoch, **{key: run[s] for key, s in SWEEP_SETTINGS.items()}))
+        timed = [e['seconds'] for e in epochs.values() if e['seconds'] != '']
+        last = epochs[max(epochs)] if len(epochs) > 0 else {'loss': '', 'accuracy': ''}
+        validated = [(float(e['val_accuracy']), epoch + 1) for epoch, e in epochs.items() if e['val_accuracy'] != '']
+        best_val, best_weights = max(validated, key = lambda v: (v[0], -v[1])) if len(validated) > 0 else ('', '') # earliest of equals
+        print(f"{i:>4} {len(timed):>6} {sum(timed) / len(timed) if len(timed) > 0 else 0:>8.1f} {last['loss']:>9} {last['accuracy']:>9} {best_val:>9} {best_weights:>6}  "
+            + ' '.join([f"{key}={run[s]}" for key, s in SWEEP_SETTINGS.items()]))
+
+    with open(summary_file, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = fields)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Results in {summary_file}")
+
 
 if __name__ == "__main__":
 
@@ -60,6 +396,7 @@ if __name__ == "__main__":
     # create a parser for command line arguments
     parser = argparse.ArgumentParser(description="")
     parser.add_argument("-c", "--config", required = True, help = "Configuration ini file.")
+    parser.add_argument("-s", "--sweep", action = "store_true", help = "Train every combination of the [sweep] settings, each run on a free GPU, and summarise them.")
 
     # read in the arguments
     args = parser.parse_args()
@@ -92,7 +429,8 @@ if __name__ == "__main__":
     permis = int(config['general']['dir_permissions'])
     
     ## Setup logger
-    logging.config.fileConfig(config['logging']['config'], defaults={'date':datetime.datetime.now().strftime("%Y%m%d-%H%M%S"),'path':model_dir,'name':'train'})
+    session_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    logging.config.fileConfig(config['logging']['config'], defaults={'date':session_id,'path':model_dir,'name':'train'})
     logger = logging.getLogger('sLogger')
 
     logger.info(f"Starting training script {v_string}")
@@ -114,32 +452,80 @@ if __name__ == "__main__":
 
     logger.info("Setting up directories.")
     
+    sampler = monitor.Sampler(model_dir, 'train', session_id, float(config['general'].get('monitor_interval', fallback = '0')), model_dir)
+    sampler.start()
+
+    settings = {'batchsize': batchsize, 'basename': basename, 'vsp': vsp, 'lrd': lrd, 'ilr': ilr}
+    patterns = (config['training'].get('loss_pattern', fallback = LOSS_PATTERN), config['training'].get('accuracy_pattern', fallback = ACCURACY_PATTERN))
+    per_run = int(config['training'].get('epochs_per_run', fallback = '0'))
+    resume = config['general'].getboolean('resume', fallback = False)
+    evaluation = eval_settings(config)
+    os.makedirs(os.path.join(model_dir, 'weights'), permis, exist_ok = True)
+    project = stage_training_set(config, model_dir, permis, logger) # where scnn reads the images and writes its weights
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
     timer_train = time()
-    for i in list(range(int(start), int(stop)+1)):
-        logger.info(f"Current ram usage (GB): {psutil.virtual_memory()[3]/1000000000:.2f}")
-        logger.info(f"Current cpu usage (%): {psutil.cpu_percent(4):.1f}")
-    
-        ## Format training call:
-        train = f'\"{scnn_cmd}\" -project {model_dir} -start {i} -stop {i+1} -batchSize {batchsize} -basename {basename} -vsp {vsp} -lrd {lrd} -ilr {ilr} -cD 0'
-        train_call = [scnn_cmd, '-project', model_dir, '-start', str(i), '-stop', str(i+1), '-batchSize', batchsize, '-basename', basename, '-vsp', vsp, '-lrd', lrd, '-ilr', ilr, '-cD', '0']
-        logger.info("Training call: " + train)
-        print(f"Starting training epoch {i}.")
-
-        result = subprocess.run(train_call, stdout = subprocess.PIPE)
-        result = result.stdout.decode('utf-8')
-        with open(model_dir + '/weights/' + basename + '_epoch-' + str(i) + '.log', 'a') as f:
-            f.write(result)
-
-        result = result.split('\n')
-
-        if len(result) > 75:
-            print(*result[76:(len(result)-1)], sep = '\n')
-            logger.debug(result[76:(len(result)-1)])
-        else:
-            logger.debug(result)
-            print(result)
-    
+    if args.sweep:
+        runs = sweep_grid(config, settings)
+        gpus = devices.from_config(config, 'training', slots_key = 'runs_per_device')
+        log_root = os.path.join(model_dir, 'sweep_' + session_id)
+        print(f"Sweeping {len(runs)} settings on {len(gpus.usable())} GPUs ({gpus.capacity()} runs at a time).")
+        logger.info(f"Sweep grid: {runs}")
+
+        # One evaluator for the whole sweep, so eval_jobs limits the evaluations of all runs together.
+        # The runs put their saved epochs on a queue and a thread here submits them.
+        evaluator = make_evaluator(evaluation, scnn_cmd, project, basename, batchsize, log_root, list(gpus.free), logger)
+        saved_epochs = None
+        if evaluator is not None:
+            manager = Manager()
+            saved_epochs = manager.Queue()
+            def forward_saved():
+                for epoch, run_basename, out_file in iter(saved_epochs.get, None):
+                    evaluator.submit(epoch, run_basename, out_file)
+            forward = threading.Thread(target = forward_saved, daemon = True)
+            forward.start()
+
+        p = Pool(max(1, gpus.capacity()))
+        dispatcher = devices.Dispatcher(p, gpus, train_run)
+        for run in runs:
+            first = resume_epoch(model_dir, run['basename'], int(start), logger) if resume else int(start)
+            dispatcher.submit((run, scnn_cmd, model_dir, project, first, int(stop), per_run, patterns, os.path.join(log_root, run['basename']), saved_epochs))
+        for job, error in dispatcher.drain():
+            if error is not None:
+                logger.error(f"Sweep run {job[0]['basename']} failed: {error}")
+            else:
+                print(f"Finished {job[0]['basename']}.")
+        p.close()
+        p.join()
+        if evaluator is not None:
+            print("Waiting for the last evaluations.")
+            saved_epochs.put(None)
+            forward.join()
+            evaluator.wait()
+            manager.shutdown()
+        sweep_summary(runs, log_root, os.path.join(model_dir, 'sweep_' + session_id + '.csv'))
+    else:
+        first = int(start)
+        if resume:
+            first = resume_epoch(model_dir, basename, first, logger)
+            if first > int(start):
+                print(f"Resuming from epoch {first}.")
+        stage_weights(project, model_dir, basename, first)
+        device = (config['training'].get('devices', fallback = '').split(',')[0].strip() or '0')
+        evaluator = make_evaluator(evaluation, scnn_cmd, project, basename, batchsize, os.path.join(model_dir, 'weights'), [device], logger)
+        train_epochs(scnn_cmd, model_dir, project, settings, first, int(stop), per_run, patterns, logger, device,
+            on_saved = evaluator.submit if evaluator is not None else None)
+        if evaluator is not None:
+            print("Waiting for the last evaluations.")
+            best = evaluator.wait()
+            if best is not None:
+                logger.info(f"Best epoch {best['epoch']} with validation accuracy {best['accuracy']}.")
+                print(f"Best epoch: {best['epoch']} (validation accuracy {best['accuracy']}, all epochs in {evaluator.out_file})")
+
     timer_train = time() - timer_train
+    sampler.stop()
 
     logger.debug(f"Training finished in {timer_train:.3f} s.")
     print(f"Finished training in {timer_train:.1f} seconds.")